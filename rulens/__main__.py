@@ -1,41 +1,261 @@
+import os
+import time
+import signal
+import asyncio
+import functools
 import argparse
-from functools import partial
+import tempfile
+import multiprocessing
 
-from . import nanomsg
-from .db import Database
+from .stats import Stats
+from .reload import Reloader
+from .db import error_kind
 
 
-def serve_request(req, *, verbose=False, db):
-    if verbose:
-        print("rulens: Got request:", repr(req))
-    _req, host, appname, topology, socktype = req.decode('ascii').split()
+def parse_request(line):
+    _req, host, appname, topology, socktype = line.split()
     assert _req == 'REQUEST', _req
     assert topology.startswith('topology://'), topology
-    result = list(db.resolve(host, appname, topology, socktype))
+    return host, appname, topology, socktype
+
+
+def topology_name(url):
+    return url[len('topology://'):].partition('?')[0]
+
+
+def error_line(exc):
+    """Returns ``ERROR <kind>`` line reported instead of addresses
+
+    It can't be confused with an address line, and a request resolving to
+    no addresses is still replied with empty message
+    """
+    return 'ERROR {}'.format(error_kind(exc))
+
+
+def serve_batch(lines, *, verbose=False, db, stats=None):
+    """Serves a batch of REQUEST lines
+
+    The reply has a frame for each request, in the order of requests: a
+    ``RESULT <number of addresses>`` line followed by the addresses, or a
+    single ``ERROR <kind>`` line if the request failed
+    """
+    parsed = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            parsed.append(parse_request(line))
+        except Exception as e:
+            parsed.append(e)
+    queries = [q for q in parsed if not isinstance(q, Exception)]
+    timings = None if stats is None else []
+    replies = iter(db.resolve_many(queries, timings))
+    timings = iter(timings or ())
+    frames = []
+    for query in parsed:
+        if isinstance(query, Exception):
+            reply = query
+            topology = socktype = '-'
+            qtimings = {}
+        else:
+            reply = next(replies)
+            topology = topology_name(query[2])
+            socktype = query[3]
+            qtimings = next(timings, {})
+        if isinstance(reply, Exception):
+            if verbose:
+                print("rulens: Error:", repr(reply))
+            if stats is not None:
+                stats.record(topology, socktype, error=error_kind(reply))
+            frames.append(error_line(reply).encode('ascii'))
+            continue
+        if stats is not None:
+            stats.record(topology, socktype, **qtimings)
+        frames.append(b'RESULT %d' % (reply.count(b'\n') + 1 if reply else 0))
+        if reply:
+            frames.append(reply)
+    result = b'\n'.join(frames)
+    if verbose:
+        print("rulens: Result:", result.decode('ascii').replace('\n', ';'))
+    return result
+
+
+def serve_who(line, *, verbose=False, db, stats=None):
+    """Serves ``WHO <address>`` request
+
+    Replies with a line per node binding or connecting to the address
+    """
+    _req, address = line.split()
+    if stats is not None:
+        stats.record('-', 'WHO')
+    result = db.who_lines(address)
     if verbose:
         print("rulens: Result:", ';'.join(result))
     return '\n'.join(result).encode('ascii')
 
 
+def serve_request(req, *, verbose=False, db, stats=None):
+    """Replies to a request, errors are replied with ``ERROR <kind>``"""
+    if verbose:
+        print("rulens: Got request:", repr(bytes(req)))
+    topology = socktype = '-'
+    timings = None
+    if stats is not None:
+        start = time.perf_counter_ns()
+        timings = {}
+    try:
+        text = str(req, 'ascii')
+        header, _, body = text.partition('\n')
+        if header.strip() == 'BATCH':
+            return serve_batch(body.splitlines(),
+                               verbose=verbose, db=db, stats=stats)
+        if header.startswith('WHO '):
+            return serve_who(header, verbose=verbose, db=db, stats=stats)
+        host, appname, url, socktype = parse_request(text)
+        topology = topology_name(url)
+        if stats is not None:
+            timings['parse'] = time.perf_counter_ns() - start
+        reply = db.resolve_reply(host, appname, url, socktype, timings)
+    except Exception as e:
+        if verbose:
+            print("rulens: Error:", repr(e))
+        if stats is not None:
+            stats.record(topology, socktype, error=error_kind(e),
+                         parse=timings.get('parse'))
+        return error_line(e).encode('ascii')
+    if stats is not None:
+        stats.record(topology, socktype, **timings)
+    if verbose:
+        print("rulens: Result:", reply.decode('ascii').replace('\n', ';'))
+    return reply
+
+
+def enable_reload(options, reloader):
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloader.reload())
+    if options.watch:
+        reloader.watch(options.watch)
+
+
+def serve_worker(options, backend, callback, reloader):
+    from . import nanomsg
+
+    # Each worker reloads its own copy of database
+    enable_reload(options, reloader)
+    nanomsg.reply_service(backend, callback, connect=True)
+
+
+def serve_workers(options, callback, reloader):
+    from . import nanomsg
+
+    backend = options.worker_address
+    if backend is None:
+        backend = 'ipc://' + os.path.join(tempfile.gettempdir(),
+            'rulens-{}.ipc'.format(os.getpid()))
+    # Fork, so that database is shared with workers instead of rebuilt
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=serve_worker,
+                           args=(options, backend, callback, reloader),
+                           daemon=True)
+               for _ in range(options.workers)]
+    for proc in workers:
+        proc.start()
+
+    def forward_signal(signum, frame):
+        for proc in workers:
+            os.kill(proc.pid, signum)
+    signal.signal(signal.SIGHUP, forward_signal)
+    try:
+        nanomsg.device(options.bind, backend)
+    finally:
+        for proc in workers:
+            proc.terminate()
+
+
+def publish_changes(publisher, generation, names):
+    """Publishes ``<topology> <generation>`` notice per changed topology
+
+    Subscribers use ``<topology> `` (with trailing space) as a topic
+    """
+    for name in names:
+        publisher.publish('{} {}'.format(name, generation).encode('ascii'))
+
+
 def main():
+    # Imported here, so that request handlers can be used without the
+    # nanomsg library
+    from . import nanomsg
+
     ap = argparse.ArgumentParser()
-    ap.add_argument('files', nargs='+',
+    ap.add_argument('files', nargs='*',
         help="Files to read topology from")
+    ap.add_argument('-s', '--snapshot', default=[], action='append',
+        help="Snapshot made by `python -m rulens.compile` to read "
+             "topology from")
     ap.add_argument('-v', '--verbose',
         help='The file name to get topology from',
         default=False, action='store_true')
     ap.add_argument('-b', '--bind',
         help='The nanomsg address to bind to for name requests',
         required=True)
+    ap.add_argument('--cache-size', type=int, default=4096,
+        help='Number of replies to keep in cache (0 disables cache)')
+    ap.add_argument('-w', '--workers', type=int, default=1,
+        help='Number of worker processes serving requests')
+    ap.add_argument('--worker-address',
+        help='The nanomsg address to pass requests to workers over '
+             '(default is ipc socket in temporary directory)')
+    ap.add_argument('--async', dest='use_async',
+        default=False, action='store_true',
+        help='Serve requests from asyncio event loop')
+    ap.add_argument('--stats', metavar='ADDR',
+        help='The nanomsg address to serve JSON snapshot of counters on')
+    ap.add_argument('--watch', type=float, metavar='SECONDS',
+        help='Check topology files for modification every SECONDS and '
+             'reload them (reload is also done on SIGHUP)')
+    ap.add_argument('--lazy', default=False, action='store_true',
+        help='Build each topology on the first request for it')
+    ap.add_argument('--preload', metavar='TOPOLOGY', default=[],
+        action='append',
+        help='Build the topology on startup and on reload in --lazy mode')
+    ap.add_argument('--publish', metavar='ADDR',
+        help='The nanomsg address to publish names of topologies changed '
+             'by each reload on')
 
     options = ap.parse_args()
+    if not options.files and not options.snapshot:
+        ap.error("Either topology files or --snapshot must be specified")
+    if options.use_async and options.workers > 1:
+        ap.error("--async can't be used with multiple --workers")
+    if options.stats and options.workers > 1:
+        ap.error("--stats can't be used with multiple --workers")
+    if options.publish and options.workers > 1:
+        ap.error("--publish can't be used with multiple --workers")
+
+    on_reload = None
+    if options.publish:
+        publisher = nanomsg.Publisher(options.publish)
+        on_reload = functools.partial(publish_changes, publisher)
+    reloader = Reloader(options.files, options.snapshot,
+                        cache_size=options.cache_size,
+                        lazy=options.lazy, preload=options.preload,
+                        verbose=options.verbose, on_reload=on_reload)
+    stats = None
+    if options.stats:
+        stats = Stats()
+        stats.serve(options.stats)
 
-    db = Database()
-    for i in options.files:
-        db.add_from_file(i)
-    nanomsg.reply_service(options.bind,
-        partial(serve_request, verbose=options.verbose, db=db))
+    def callback(req):
+        return serve_request(req,
+            verbose=options.verbose, db=reloader.db, stats=stats)
 
+    if options.workers > 1:
+        serve_workers(options, callback, reloader)
+        return
+    enable_reload(options, reloader)
+    if options.use_async:
+        asyncio.run(nanomsg.async_reply_service(options.bind, callback))
+    else:
+        nanomsg.reply_service(options.bind, callback)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,7 @@
+"""
+    Benchmarks of the name service on synthetic topologies
+
+    Run ``python -m rulens.bench.generate`` to write a topology with matching
+    address list, and ``python -m rulens.bench`` to run the suite and print
+    results as JSON.
+"""
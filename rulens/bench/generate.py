@@ -0,0 +1,187 @@
+"""
+    Generator of synthetic topologies
+
+    Topologies mimic the ones in ``examples/``: a number of "cluster" groups
+    (several per datacenter) tied together by the "world" layout, optional
+    "subcluster" groups matched by worker ip, and a "public" extern topology.
+"""
+import os
+import argparse
+import ipaddress
+
+import yaml
+
+
+ROLES = ('frontend', 'balancer', 'gateway_input', 'gateway_output', 'worker')
+
+
+def _layouts(skip_same):
+    return {
+        'cluster': {
+            'balancer -> worker': {'port': 10001},
+            'balancer <- frontend': {'port': 10006},
+            'gateway_input <- _gateway_in': {'port': 10002},
+            '_gateway_out <- gateway_output': {'port': 10002},
+            'frontend <- _api': {
+                'match_by': 'id',
+                'ports': {'1': 10100, '2': 10101},
+                },
+            'gateway_input -> balancer': {'port': 10007},
+            'balancer -> gateway_output': {'port': 10005, 'priority': 10},
+            },
+        'subcluster': {
+            '_worker -> device': None,
+            'device -> worker': {'addr': 'ipc:///tmp/device'},
+            },
+        'world': {
+            'api <- _public': None,
+            'gateway_in <- gateway_out':
+                {'skip_same': 'dc'} if skip_same else None,
+            },
+        }
+
+
+def generate(*, dcs=3, groups=1, nodes=10, rules=0, default='all',
+             skip_same=True, subclusters=0):
+    """Returns topology data and list of lines for addresses file
+
+    :param dcs: number of datacenters
+    :param groups: number of "cluster" groups in each datacenter
+    :param nodes: number of nodes of each role in each group
+    :param rules: number of ``match_by: ip`` rules pinning workers to
+        balancers in each group
+    :param default: what to connect unpinned workers to
+    :param skip_same: whether gateways skip their own datacenter
+    :param subclusters: number of workers having "subcluster" layout
+    """
+    ips = (str(ipaddress.IPv4Address(i))
+           for i in range(int(ipaddress.IPv4Address('10.0.0.1')), 1 << 32))
+    group_data = {}
+    lines = []
+    workers = []
+    for dc in range(1, dcs + 1):
+        dcname = 'dc{}'.format(dc)
+        lines.append('##### {} #####'.format(dcname))
+        for grp in range(1, groups + 1):
+            gname = 'cluster{}_{}'.format(dc, grp)
+            children = {role: [{'ip': next(ips)} for _ in range(nodes)]
+                        for role in ROLES}
+            gdata = group_data[gname] = {
+                'layout': 'cluster',
+                'rule': {'dc': dcname, 'cluster': gname},
+                'children': children,
+                }
+            if rules:
+                balancers = [c['ip'] for c in children['balancer']]
+                gdata['connections'] = {
+                    'balancer -> worker': {
+                        'match_by': 'ip',
+                        'rules': [
+                            '{} -> {}'.format(balancers[i % len(balancers)],
+                                              w['ip'])
+                            for i, w in enumerate(children['worker'][:rules])
+                            ],
+                        'default': default,
+                        },
+                    }
+            workers.extend(c['ip'] for c in children['worker'])
+            for role in ROLES:
+                for num, child in enumerate(children[role]):
+                    query = 'ip={}&dc={}&cluster={}&role={}&hostname=h{}&pid={}'\
+                        .format(child['ip'], dcname, gname, role,
+                                child['ip'].replace('.', '_'), num)
+                    if role == 'frontend':
+                        for id in ('1', '2'):
+                            lines.append('topology://internal?{}&id={} device'
+                                         .format(query, id))
+                    elif role == 'worker':
+                        lines.append('topology://internal?{} NN_REP'
+                                     .format(query))
+                    else:
+                        lines.append('topology://internal?{} device'
+                                     .format(query))
+    for num, ip in enumerate(workers[:subclusters], 1):
+        group_data['subcluster{}'.format(num)] = {
+            'match_topology': 'internal',
+            'layout': 'subcluster',
+            'rule': {'ip': ip},
+            }
+    data = {
+        'layouts': _layouts(skip_same),
+        'groups': group_data,
+        'topologies': {
+            'internal': {
+                'type': 'reqrep',
+                'layout': 'world',
+                'children': [name for name in group_data
+                             if name.startswith('cluster')],
+                },
+            'public': {
+                'type': 'reqrep',
+                'topology': 'internal',
+                'slot': '_public',
+                },
+            },
+        }
+    return data, lines
+
+
+def add_arguments(ap):
+    ap.add_argument('--dcs', type=int, default=3,
+        help="Number of datacenters")
+    ap.add_argument('--groups', type=int, default=1,
+        help="Number of cluster groups per datacenter")
+    ap.add_argument('--nodes', type=int, default=10,
+        help="Number of nodes per role in each group")
+    ap.add_argument('--rules', type=int, default=0,
+        help="Number of balancer to worker match_by rules per group")
+    ap.add_argument('--default', default='all',
+        help="What unmatched workers connect to (`all`, `random`, `hash` "
+             "or `rendezvous`)")
+    ap.add_argument('--no-skip-same', dest='skip_same',
+        default=True, action='store_false',
+        help="Connect gateways to their own datacenter too")
+    ap.add_argument('--subclusters', type=int, default=0,
+        help="Number of workers having subcluster layout")
+
+
+def generator_params(options):
+    return {
+        'dcs': options.dcs,
+        'groups': options.groups,
+        'nodes': options.nodes,
+        'rules': options.rules,
+        'default': options.default,
+        'skip_same': options.skip_same,
+        'subclusters': options.subclusters,
+        }
+
+
+def write(directory, data, lines):
+    """Writes ``topology.yaml`` and ``addresses.txt`` to the directory"""
+    dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    topology = os.path.join(directory, 'topology.yaml')
+    addresses = os.path.join(directory, 'addresses.txt')
+    with open(topology, 'wt') as f:
+        yaml.dump(data, f, Dumper=dumper, default_flow_style=False)
+    with open(addresses, 'wt') as f:
+        for line in lines:
+            print(line, file=f)
+    return topology, addresses
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('directory',
+        help="Directory to write topology.yaml and addresses.txt to")
+    add_arguments(ap)
+    options = ap.parse_args()
+
+    os.makedirs(options.directory, exist_ok=True)
+    for fn in write(options.directory,
+                    *generate(**generator_params(options))):
+        print("Written", fn)
+
+
+if __name__ == '__main__':
+    main()
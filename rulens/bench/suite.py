@@ -0,0 +1,268 @@
+"""
+    Benchmark suite, results are printed as JSON
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+from ..db import Database, load_file
+from ..builder import TopologyBuilder
+from ..topology import match_rule, rule_requirements
+from . import generate
+
+
+def percentiles(samples):
+    """Returns latency percentiles in microseconds for list of nanoseconds"""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    last = len(samples) - 1
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples) / 1000,
+        'p50': samples[last * 50 // 100] / 1000,
+        'p90': samples[last * 90 // 100] / 1000,
+        'p99': samples[last * 99 // 100] / 1000,
+        'max': samples[last] / 1000,
+        }
+
+
+def read_queries(filename):
+    queries = []
+    with open(filename, 'rt') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            url, nodetype = line.split()
+            if nodetype == 'device':
+                socktypes = ('NN_REQ', 'NN_REP')
+            else:
+                socktypes = (nodetype,)
+            for socktype in socktypes:
+                queries.append((None, None, url, socktype))
+    return queries
+
+
+def _all_nodes(topologies):
+    nodes = {}
+    for top in topologies.values():
+        for nlist in top.rules.values():
+            for n in nlist:
+                nodes[n] = None
+    return list(nodes)
+
+
+def bench_build(topology):
+    start = time.perf_counter()
+    data = load_file(topology)
+    loaded = time.perf_counter()
+    topologies = dict(TopologyBuilder(data).topologies())
+    built = time.perf_counter()
+    return topologies, {
+        'yaml_load': loaded - start,
+        'build': built - loaded,
+        'topologies': len(topologies),
+        'nodes': len(_all_nodes(topologies)),
+        }
+
+
+def bench_memory(data):
+    """Measures memory allocated by building topologies from loaded data"""
+    tracemalloc.start()
+    try:
+        topologies = dict(TopologyBuilder(data).topologies())
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    nodes = len(_all_nodes(topologies))
+    return {
+        'current_kb': current // 1024,
+        'peak_kb': peak // 1024,
+        'bytes_per_node': current // nodes if nodes else None,
+        }
+
+
+def bench_nodes(topologies, repeat=10):
+    """Measures ``get_property`` and ``match_rule`` per call
+
+    Supernodes are skipped, as matching them is proportional to the number
+    of their children
+    """
+    nodes = [n for n in _all_nodes(topologies) if not n.children]
+    props = [rule_requirements(n) or {} for n in nodes]
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        for n in nodes:
+            n.get_property('ip')
+    got = time.perf_counter_ns()
+    for _ in range(repeat):
+        for p, n in zip(props, nodes):
+            match_rule(p, n)
+    matched = time.perf_counter_ns()
+    calls = len(nodes) * repeat
+    return {
+        'get_property_ns': (got - start) / calls if calls else None,
+        'match_rule_ns': (matched - got) / calls if calls else None,
+        }
+
+
+def bench_resolve(db, queries):
+    errors = 0
+    resolve = []
+    for q in queries:
+        start = time.perf_counter_ns()
+        try:
+            list(db.resolve(*q))
+        except Exception:
+            errors += 1
+            continue
+        resolve.append(time.perf_counter_ns() - start)
+    passes = {}
+    db.cache.clear()
+    for name in ('cold', 'warm'):
+        samples = passes[name] = []
+        for q in queries:
+            start = time.perf_counter_ns()
+            try:
+                db.resolve_reply(*q)
+            except Exception:
+                continue
+            samples.append(time.perf_counter_ns() - start)
+    return {
+        'queries': len(queries),
+        'errors': errors,
+        'resolve': percentiles(resolve),
+        'resolve_reply_cold': percentiles(passes['cold']),
+        'resolve_reply_warm': percentiles(passes['warm']),
+        'cache': {
+            'hits': db.cache.hits,
+            'misses': db.cache.misses,
+            'evictions': db.cache.evictions,
+            },
+        }
+
+
+def _rss_kb(pid):
+    with open('/proc/{}/status'.format(pid), 'rt') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def bench_server(topology, queries, requests, directory):
+    """Measures round trips to ``python -m rulens`` over ipc socket
+
+    RSS of the server is recorded after warm up and at the end, to spot
+    leaks on long runs
+    """
+    from .. import nanomsg
+
+    addr = 'ipc://' + os.path.join(directory, 'name_service.ipc')
+    proc = subprocess.Popen([sys.executable, '-m', 'rulens',
+                             topology, '--bind', addr])
+    sock = nanomsg.lib.nn_socket(nanomsg.const.AF_SP, nanomsg.const.REQ)
+    try:
+        nanomsg.lib.nn_connect(sock, addr.encode('ascii'))
+        reqs = ['REQUEST {} {} {} {}'.format(
+                    host or '-', appname or '-', url, socktype).encode('ascii')
+                for host, appname, url, socktype in queries]
+
+        def roundtrip(req):
+            start = time.perf_counter_ns()
+            nanomsg.send_msg(sock, req)
+            nanomsg.recv_msg(sock).free()
+            return time.perf_counter_ns() - start
+
+        for req in reqs:  # warm up, also waits for server to start
+            roundtrip(req)
+        rss_start = _rss_kb(proc.pid)
+        samples = [roundtrip(reqs[i % len(reqs)]) for i in range(requests)]
+        rss_end = _rss_kb(proc.pid)
+    finally:
+        nanomsg.lib.nn_close(sock)
+        proc.terminate()
+        proc.wait()
+    return {
+        'requests': requests,
+        'roundtrip': percentiles(samples),
+        'server_rss_kb_start': rss_start,
+        'server_rss_kb_end': rss_end,
+        }
+
+
+def run(options, directory):
+    if options.topology:
+        topology = options.topology
+        addresses = options.addresses
+        params = None
+    else:
+        params = generate.generator_params(options)
+        topology, addresses = generate.write(directory,
+            *generate.generate(**params))
+
+    topologies, build = bench_build(topology)
+    memory = bench_memory(load_file(topology))
+    db = Database()
+    db.topologies.update(topologies)
+    queries = read_queries(addresses) if addresses else []
+    rnd = random.Random(options.seed)
+    if len(queries) > options.samples:
+        queries = rnd.sample(queries, options.samples)
+
+    results = {
+        'build': build,
+        'memory': memory,
+        'nodes': bench_nodes(topologies),
+        'resolve': bench_resolve(db, queries),
+        }
+    if options.requests and queries:
+        try:
+            results['server'] = bench_server(
+                topology, queries, options.requests, directory)
+        except (OSError, AttributeError) as e:
+            results['server'] = {'error': str(e)}
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'generator': params,
+        'topology': topology if options.topology else None,
+        'results': results,
+        }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--topology',
+        help="Benchmark existing topology file instead of generated one")
+    ap.add_argument('--addresses',
+        help="Address list for --topology")
+    generate.add_arguments(ap)
+    ap.add_argument('--samples', type=int, default=10000,
+        help="Number of queries to sample from address list")
+    ap.add_argument('--requests', type=int, default=0,
+        help="Number of round trips to the server (0 skips the server)")
+    ap.add_argument('--seed', type=int, default=0,
+        help="Seed for sampling queries")
+    ap.add_argument('-o', '--output',
+        help="File to write JSON results to (default is stdout)")
+    options = ap.parse_args()
+    if options.addresses and not options.topology:
+        ap.error("--addresses can only be used with --topology")
+
+    with tempfile.TemporaryDirectory(prefix='rulens-bench-') as directory:
+        result = run(options, directory)
+
+    if options.output:
+        with open(options.output, 'wt') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
@@ -1,6 +1,9 @@
+import sys
+import math
+import bisect
 import random
+import hashlib
 from collections import defaultdict
-from itertools import groupby
 
 from .topology import Topology, ExternTopology
 
@@ -29,62 +32,55 @@ class Connection(object):
     def abstract(self):
         return self.source.startswith('_') or self.sink.startswith('_')
 
+    def _expand(self, raw, party, peers):
+        """Returns nodes of ``raw`` list with supernodes resolved
+
+        Supernode is replaced by the ``peers`` of connections of ``party`` of
+        its children, and the connections are deleted. Peers are appended to
+        ``raw`` (which is a list of nodes of the role) as they may be
+        supernodes themselves.
+        """
+        result = {}  # dict preserves order, unlike set
+        i = 0
+        while i < len(raw):
+            n = raw[i]
+            i += 1
+            if not isinstance(n, SuperNode):
+                result[n] = None
+                continue
+            for ch in n.children:
+                for conn in tuple(ch.connections[party]):
+                    raw.extend(getattr(conn, peers))
+                    if conn.info.port is not None:
+                        if self.port is not None:
+                            assert self.port == conn.info.port, \
+                                (self.port, conn.info.port)
+                        else:
+                            self.port = conn.info.port
+                    if conn.info.ports is not None:  # kinda dirty
+                        self.ports = conn.info.ports
+                        self.match_by = conn.info.match_by
+                    conn.delete()
+        return list(result)
+
     def instantiate(self, nodes, info=None):
-        rawsrc = nodes[self.source]
-        rawtgt = nodes[self.sink]
-
-        src = set()
-        for n in rawsrc:
-            if hasattr(n, 'children'):
-                for ch in n.children:
-                    for conn in ch.connections['sink']:
-                        rawsrc.extend(conn.sources)
-                        if conn.info.port is not None:
-                            if self.port is not None:
-                                assert self.port == conn.info.port, \
-                                    (self.port, conn.info.port)
-                            else:
-                                self.port = conn.info.port
-                        if conn.info.ports is not None:  # kinda dirty
-                            self.ports = conn.info.ports
-                            self.match_by = conn.info.match_by
-                        conn.delete()
-            else:
-                src.add(n)
-
-        tgt = set()
-        for n in rawtgt:
-            if hasattr(n, 'children'):
-                for ch in n.children:
-                    for conn in ch.connections['source']:
-                        rawtgt.extend(conn.sinks)
-                        if conn.info.port is not None:
-                            if self.port is not None:
-                                assert self.port == conn.info.port, \
-                                    (self.port, conn.info.port)
-                            else:
-                                self.port = conn.info.port
-                        if conn.info.ports is not None:  # kinda dirty
-                            self.ports = conn.info.ports
-                            self.match_by = conn.info.match_by
-                        conn.delete()
-            else:
-                tgt.add(n)
+        src = self._expand(nodes[self.source], 'sink', 'sources')
+        tgt = self._expand(nodes[self.sink], 'source', 'sinks')
 
         skip = self.skip_same
         if skip:
-            skip_key = lambda n: n.get_property(skip)
-            for sprop, snodes in groupby(sorted(src, key=skip_key), key=skip_key):
-                snodes = list(snodes)
-                tnodes = [n for n in tgt if n.get_property(skip) != sprop]
+            groups = defaultdict(list)
+            for n in src:
+                groups[n.get_property(skip)].append(n)
+            tprops = [(n, n.get_property(skip)) for n in tgt]
+            for sprop, snodes in groups.items():
+                tnodes = [n for n, tprop in tprops if tprop != sprop]
                 ci = ConnectionInstance(self, snodes, tnodes, **(info or {}))
                 for n in snodes:
                     n.add_source_connection(ci)
                 for n in tnodes:
                     n.add_sink_connection(ci)
         else:
-            src = list(src)
-            tgt = list(tgt)
             ci = ConnectionInstance(self, src, tgt, **(info or {}))
             for n in src:
                 n.add_source_connection(ci)
@@ -105,113 +101,296 @@ class Connection(object):
 
 
 
+def _hash(*parts):
+    data = '\0'.join(parts).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def node_key(node, skip=()):
+    """Returns string identifying node by its properties across builds"""
+    return ','.join(sorted('{}={}'.format(k, v)
+                           for k, v in node.properties.items()
+                           if k not in skip))
+
+
 class ConnectionInstance(object):
+    """Connection between nodes of particular groups
+
+    The ``default`` tells what node not listed in ``match_by`` rules
+    connects to:
+
+    * ``all`` -- every bound node
+    * ``random`` -- random bound node, may change on every request
+    * ``hash`` -- bound node chosen by consistent hashing of the value of
+      ``hash_by`` property (``match_by`` by default) of connecting node
+    * ``rendezvous`` -- the same but by rendezvous hashing, weighted by
+      ``weight`` property of bound nodes
+    """
+    STRATEGIES = ('all', 'random', 'hash', 'rendezvous')
+    RING_POINTS = 64
 
     def __init__(self, info, sources, sinks, *,
-        match_by=None, rules=(), default='all'):
+        match_by=None, rules=(), default='all', hash_by=None):
         #assert info.abstract or sources and sinks, info
+        if default not in self.STRATEGIES:
+            raise ValueError("Wrong default {!r} for {}->{}"
+                .format(default, info.source, info.sink))
         self.sources = sources
         self.sinks = sinks
+        self._source_set = frozenset(sources)
+        self._sink_set = frozenset(sinks)
         self.info = info
         self.match_by = match_by
         self.rules = rules
         self.default = default
+        self.hash_by = hash_by
+        self._bind = None  # see materialize()
+
+    @property
+    def deterministic(self):
+        """Whether ``address_for`` always gives same result for same node"""
+        return not self.match_by or self.default != 'random'
 
     def delete(self):
         for n in self.sources:
-            n.connections['source'].remove(self)
+            del n.connections['source'][self]
         for n in self.sinks:
-            n.connections['sink'].remove(self)
+            del n.connections['sink'][self]
 
     def __repr__(self):
         return ("<{0.__class__.__name__} {0.info.source}->{0.info.sink}>"
             .format(self))
 
-    def _addr(self, nodes, props=None):
+    def materialize(self):
+        """Precomputes reply lines, done once when topology is built
+
+        Lines are kept for every node of the bound party: the ones to bind
+        (keyed by ``match_by`` value when ``ports`` are used) and the ones
+        peers connect to. Missing ip or port is stored as ``None`` and
+        reported when such node is resolved, like it has always been.
+        """
+        if self._bind is not None:
+            return
         info = self.info
+        if info.bound == info.source:
+            bound = self.sources
+            bind_prefix = 'bind:{}:'.format(info.priority)
+            connect_prefix = 'connect:8:'
+        else:
+            bound = self.sinks
+            bind_prefix = 'bind:8:'
+            connect_prefix = 'connect:{}:'.format(info.priority)
+        bind = {}
+        connect = {}
+        for n in bound:
+            bind[n], connect[n] = self._lines(n, bind_prefix, connect_prefix)
         if info.addr:
-            yield info.addr
-            return
+            self._connect_all = (connect_prefix + info.addr,)
+        elif all(lines is not None for lines in connect.values()):
+            self._connect_all = tuple(line
+                for lines in connect.values() for line in lines)
+        else:
+            self._connect_all = None
+        self._connect = connect
+        self._bound = bound
+        self._routes = self._compile_rules(bound) if self.match_by else {}
+        if self.match_by and self.default in ('hash', 'rendezvous'):
+            self._compile_hashing(bound)
+        # Assigned last, as it marks instance materialized
+        self._bind = bind
+
+    def _compile_rules(self, bound):
+        """Makes index of ``rules`` by value of the connecting node
+
+        Rule ``a -> b`` means node having ``match_by`` property ``b``
+        connects to the bound nodes having the property ``a``
+        """
+        by_value = defaultdict(list)
+        for n in bound:
+            val = n.get_property(self.match_by)
+            if val is not None:
+                by_value[str(val)].append(n)
+        routes = {}
+        for rule in self.rules:
+            peer, arrow, value = str(rule).partition(' -> ')
+            if not arrow:
+                raise ValueError("Wrong rule {!r} for {!r}".format(rule, self))
+            nodes = by_value.get(peer)
+            if not nodes:
+                raise ValueError("Rule {!r} for {!r} references unknown node"
+                    .format(rule, self))
+            lst = routes.setdefault(value, [])
+            lst.extend(n for n in nodes if n not in lst)
+        return routes
+
+    def _compile_hashing(self, bound):
+        weighted = []
+        for n in bound:
+            weight = float(n.get_property('weight', 1))
+            if not weight > 0:
+                raise ValueError("Wrong weight {!r} of {!r}".format(weight, n))
+            # a node keeps its hashes when only its weight is changed
+            weighted.append((node_key(n, ('weight',)), weight, n))
+        if self.default == 'rendezvous':
+            self._weighted = weighted
+        else:
+            ring = []
+            for key, weight, n in weighted:
+                for i in range(max(1, round(self.RING_POINTS * weight))):
+                    ring.append((_hash(key, str(i)), key, n))
+            ring.sort(key=lambda item: item[:2])
+            self._ring_points = [point for point, _, _ in ring]
+            self._ring_nodes = [n for _, _, n in ring]
+
+    def _pick(self, props):
+        """Picks bound node for connecting node not listed in the rules"""
+        if not self._bound:
+            raise IndexError("No nodes to connect {!r} to".format(self))
+        if self.default == 'random':
+            return random.choice(self._bound)
+        value = str(props[self.hash_by or self.match_by])
+        if self.default == 'hash':
+            idx = bisect.bisect(self._ring_points, _hash(value))
+            return self._ring_nodes[idx % len(self._ring_nodes)]
+        best = None
+        for key, weight, n in self._weighted:
+            # uniform in (0, 1), so that logarithm is negative
+            uniform = (_hash(key, value) + 0.5) / (1 << 64)
+            score = weight / -math.log(uniform)
+            if best is None or score > best[0]:
+                best = score, n
+        return best[1]
+
+    def _lines(self, node, bind, connect):
+        info = self.info
+        if info.addr:
+            return (bind + info.addr,), (connect + info.addr,)
+        ip = node.get_property('ip')
+        if not ip:
+            return None, None
+        if info.port:
+            addr = 'tcp://{}:{}'.format(ip, info.port)
+            # every one of ``ports`` is connected to, even if port is fixed
+            count = len(info.ports) if info.ports else 1
+            return (bind + addr,), (connect + addr,) * count
+        if not (info.ports and info.match_by):
+            return None, None
+        addrs = {key: 'tcp://{}:{}'.format(ip, port)
+                 for key, port in info.ports.items()}
+        return ({key: (bind + addr,) for key, addr in addrs.items()},
+                tuple(connect + addr for addr in addrs.values()))
+
+    def _bind_lines(self, node, props):
+        lines = self._bind[node]
+        if lines is None:
+            raise AssertionError("No address for node", node)
+        if isinstance(lines, dict):
+            return lines[props[self.info.match_by]]
+        return lines
+
+    def _connect_lines(self, nodes=None):
+        """Returns lines to connect to nodes, to all bound nodes if None"""
         if nodes is None:
-            if info.bound == info.source:
-                nodes = self.sources
-            else:
-                nodes = self.sinks
+            if self._connect_all is not None:
+                return self._connect_all
+            nodes = self._connect
+        elif self.info.addr:
+            return self._connect_all
+        result = []
         for n in nodes:
-            if info.ports and props is None:
-                for key in self.info.ports:
-                    yield self._single_addr(n, {info.match_by: key})
-            else:
-                yield self._single_addr(n, props)
-
-    def _single_addr(self, node, props):
-        ip = None
-        for r in node.rules:
-            if 'ip' in r:
-                ip = r['ip']
-        port = self.info.port
-        assert ip, node
-        if not port:
-            assert self.info.ports and self.info.match_by, node
-            port = self.info.ports[props[self.info.match_by]]
-        return 'tcp://{}:{}'.format(ip, port)
+            lines = self._connect[n]
+            if lines is None:
+                raise AssertionError("No address for node", n)
+            result.extend(lines)
+        return result
 
     def address_for(self, node, props):
         info = self.info
-        if node in self.sources:
-            if info.bound == info.source:
-                for a in self._addr([node], props):
-                    yield 'bind:{}:{}'.format(info.priority, a)
-            else:
-                if info.sink.startswith('_'):
-                    return
-                if self.match_by:
-                    sinks = []
-                    myval = props[self.match_by]
-                    for t in self.sinks:
-                        val = t.get_property(self.match_by)
-                        if val is not None:
-                            conn = '{} -> {}'.format(val, myval)
-                            if conn in self.rules:
-                                sinks.append(t)
-                            break
-                    if not sinks:
-                        if self.default == 'all':
-                            sinks = self.sinks
-                        else:
-                            sinks = [random.choice(self.sinks)]
-                else:
-                    sinks = self.sinks
-                for a in self._addr(sinks):
-                    yield 'connect:{}:{}'.format(info.priority, a)
-        elif node in self.sinks:
-            if info.bound == info.sink:
-                for a in self._addr([node], props):
-                    yield 'bind:8:{}'.format(a)
-            else:
-                if info.source.startswith('_'):
-                    return
-                if self.match_by:
-                    sources = []
-                    myval = props[self.match_by]
-                    for t in self.sources:
-                        val = t.get_property(self.match_by)
-                        if val is not None:
-                            conn = '{} -> {}'.format(val, myval)
-                            if conn in self.rules:
-                                sources.append(t)
-                            break
-                    if not sources:
-                        if self.default == 'all':
-                            sources = self.sources
-                        else:
-                            sources = [random.choice(self.sources)]
-                else:
-                    sources = self.sources
-                for a in self._addr(sources):
-                    yield 'connect:8:{}'.format(a)
+        if node in self._source_set:
+            bound = info.bound == info.source
+            peer = info.sink
+        elif node in self._sink_set:
+            bound = info.bound == info.sink
+            peer = info.source
         else:
             raise AssertionError("Wrong node {!r}".format(node))
+        if self._bind is None:
+            self.materialize()
+        if bound:
+            return self._bind_lines(node, props)
+        if peer.startswith('_'):
+            return ()
+        nodes = None
+        if self.match_by:
+            nodes = self._routes.get(str(props[self.match_by]))
+            if nodes is None and self.default != 'all':
+                nodes = [self._pick(props)]
+        return self._connect_lines(nodes)
+
+    def fingerprint(self):
+        """Returns a value equal for instances answering the same
+
+        Bound nodes are compared by role and properties, so instances of
+        different builds may be compared
+        """
+        if self._bind is None:
+            self.materialize()
+        bound = []
+        for n in self._bound:
+            lines = self._bind[n]
+            if isinstance(lines, dict):
+                lines = tuple(sorted(lines.items()))
+            bound.append((n.name, node_key(n), lines, self._connect[n]))
+        info = self.info
+        return (info.source, info.sink, info.bound, info.addr,
+                self.match_by, tuple(str(r) for r in self.rules),
+                self.default, self.hash_by, tuple(bound))
+
+    def endpoints(self):
+        """Yields ``(nodes, line)`` for every line any node may get
+
+        Connecting nodes are resolved with their own properties, and the ones
+        getting the same bound nodes are yielded together, so that lines
+        aren't repeated for each of them. The ones which connect depending
+        on request parameters they don't have, or randomly, are reported as
+        connecting to every bound node.
+        """
+        if self._bind is None:
+            self.materialize()
+        info = self.info
+        for node, lines in self._bind.items():
+            if isinstance(lines, dict):
+                lines = [l for lst in lines.values() for l in lst]
+            for line in lines or ():
+                yield (node,), line
+        if info.bound == info.source:
+            peer, peers = info.sink, self.sinks
+        else:
+            peer, peers = info.source, self.sources
+        if peer.startswith('_'):
+            return
+        if info.addr:
+            for line in self._connect_all:
+                yield peers, line
+            return
+        groups = {}  # id of bound nodes -> (bound nodes, connecting nodes)
+        for node in peers:
+            nodes = self._bound
+            if self.match_by:
+                value = node.get_property(self.match_by)
+                routed = self._routes.get(str(value))
+                if routed is not None:
+                    nodes = routed
+                elif self.default in ('hash', 'rendezvous'):
+                    try:
+                        nodes = (self._pick(node.properties),)
+                    except KeyError:
+                        pass
+            key = id(nodes[0]) if len(nodes) == 1 else id(nodes)
+            groups.setdefault(key, (nodes, []))[1].append(node)
+        for nodes, group in groups.values():
+            for line in [l for n in nodes for l in self._connect[n] or ()]:
+                yield group, line
 
 
 class Layout(object):
@@ -267,69 +446,162 @@ class ConnectAddress(object):
 
 
 class Node(object):
+    """Node of a topology
+
+    Properties of all the rules are merged into ``properties``, later rules
+    taking precedence. Once topology is built, node is frozen: connection
+    instances are kept in tuples shared between nodes having the same ones.
+    """
+    __slots__ = ('group', 'name', 'rules', 'properties', 'connections',
+                 'parent')
+    children = ()
 
     def __init__(self, name, matched_by_rules=(), group=None):
         self.group = group
         self.name = name
         self.rules = tuple(matched_by_rules)
+        self.properties = _merge_properties(self.rules)
+        # dicts are used as ordered sets of connection instances
         self.connections = {
-            'source': [],
-            'sink': [],
+            'source': {},
+            'sink': {},
             }
         self.parent = None
 
-    @classmethod
-    def supernode(Node, name, nodes):
-        self = Node(name, [])
-        self.children = nodes
-        for n in nodes:
-            assert n.parent is None, n
-            n.parent = self
-        return self
-
     @property
     def abstract(self):
         return self.name.startswith('_')
 
     def get_property(self, name, default=None):
-        for r in reversed(self.rules):
-            if name in r:
-                return r[name]
-        return default
+        return self.properties.get(name, default)
 
     def add_source_connection(self, conn):
-        self.connections['source'].append(conn)
+        self.connections['source'][conn] = None
 
     def add_sink_connection(self, conn):
-        self.connections['sink'].append(conn)
+        self.connections['sink'][conn] = None
+
+    def freeze(self, shared):
+        """Replaces connection sets by tuples
+
+        The ``shared`` dict is used to reuse equal connection mappings
+        """
+        conns = self.connections
+        if isinstance(conns['source'], tuple):
+            return
+        key = tuple(conns['source']), tuple(conns['sink'])
+        frozen = shared.get(key)
+        if frozen is None:
+            frozen = shared[key] = {'source': key[0], 'sink': key[1]}
+        self.connections = frozen
 
     def __repr__(self):
-        if hasattr(self, 'children'):
-            return '<SuperNode {!r} {!r}>'.format(self.name, self.children)
-        else:
-            return '<Node {!r} {!r}>'.format(self.name, self.rules)
+        return '<Node {!r} {!r}>'.format(self.name, self.rules)
+
+
+class SuperNode(Node):
+    """Node standing for the nodes of an abstract role of the groups"""
+    __slots__ = ('children',)
+
+    def __init__(self, name, nodes):
+        super().__init__(name)
+        self.children = tuple(nodes)
+        for n in self.children:
+            assert n.parent is None, n
+            n.parent = self
+
+    def freeze(self, shared):
+        super().freeze(shared)
+        for n in self.children:
+            n.freeze(shared)
+
+    def __repr__(self):
+        return '<SuperNode {!r} {!r}>'.format(self.name, self.children)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _merge_properties(rules):
+    props = {}
+    for r in rules:
+        for k, v in r.items():
+            props[_intern(k)] = _intern(v)
+    return props
+
+
+def finalize(top):
+    """Prepares built topology for resolving nodes"""
+    shared = {}
+    for nodes in top.rules.values():
+        for node in nodes:
+            node.freeze(shared)
+            for conns in node.connections.values():
+                for conn in conns:
+                    conn.materialize()
+    top.build_index()
 
 
 class TopologyBuilder(object):
 
     def __init__(self, data):
-        self._layouts = {name: Layout(val)
-            for name, val in data['layouts'].items()}
+        self._layout_data = data['layouts']
+        # Layouts are parsed here to report errors early, but each topology
+        # is built from fresh copies, because building updates connections
+        for val in self._layout_data.values():
+            Layout(val)
+        self._layouts = {}
         self._groups = data['groups']
         self._topologies = data['topologies']
+        self._by_match_topology = defaultdict(list)
+        for groupname, g in self._groups.items():
+            if g.get('match_topology') is not None:
+                self._by_match_topology[g['match_topology']].append(groupname)
+
+    def _layout(self, name):
+        layout = self._layouts.get(name)
+        if layout is None:
+            layout = self._layouts[name] = Layout(self._layout_data[name])
+        return layout
+
+    def dependencies(self, name):
+        """Returns sets of layouts, groups and topologies topology is built of
+        """
+        properties = self._topologies[name]
+        if 'topology' in properties:
+            return set(), set(), {properties['topology']}
+        layouts = {properties['layout']}
+        groups = set(properties.get('children', ()))
+        if groups:
+            groups.update(self._by_match_topology.get(name, ()))
+        for g in groups:
+            layouts.add(self._groups[g]['layout'])
+        return layouts, groups, set()
+
+    def signature(self, name):
+        """Returns all the data topology is built from
+
+        Topology needs to be rebuilt only if signature differs in the new
+        version of the data
+        """
+        layouts, groups, topologies = self.dependencies(name)
+        return (self._topologies[name],
+                {l: self._layout_data[l] for l in layouts},
+                {g: self._groups[g] for g in groups},
+                {t: self.signature(t) for t in topologies})
 
     def _add_matching_groups(self, top, nodes):
-        for groupname, g in self._groups.items():
-            if g.get('match_topology') != top.name:
-                continue
-            l = self._layouts[g['layout']]
+        for groupname in self._by_match_topology.get(top.name, ()):
+            g = self._groups[groupname]
+            l = self._layout(g['layout'])
             groupnodes = self._process_group(groupname, g, l)
             for conn in l._connections:
                 conn.instantiate(groupnodes)
             for role, nlist in groupnodes.items():
                 if role.startswith('_'):
                     name = role[1:]
-                    nodes[name].append(Node.supernode(name, nlist))
+                    nodes[name].append(SuperNode(name, nlist))
                 else:
                     for node in nlist:
                         top.add_rule(role, node)
@@ -339,7 +611,7 @@ class TopologyBuilder(object):
 
         for i in children:
             g = self._groups[i]
-            l = self._layouts[g['layout']]
+            l = self._layout(g['layout'])
             groupnodes = self._process_group(i, g, l)
             self._add_matching_groups(top, groupnodes)
             cinfo = {Connection.canonical_key(k): v
@@ -349,11 +621,11 @@ class TopologyBuilder(object):
             for role, nlist in groupnodes.items():
                 if role.startswith('_'):
                     name = role[1:]
-                    nodes[name].append(Node.supernode(name, nlist))
+                    nodes[name].append(SuperNode(name, nlist))
                 else:
                     nodes[role].extend(nlist)
 
-        l = self._layouts[layout]
+        l = self._layout(layout)
         for ep in l._roles:
             if not ep in nodes:
                 node = Node(ep)
@@ -383,22 +655,67 @@ class TopologyBuilder(object):
         return by_role
 
 
-    def topologies(self):
-        topologies = {}
-        # First made topologies having layout
+    def check(self):
+        """Raises ValueError if topologies refer to undefined items"""
         for name, properties in self._topologies.items():
+            if 'topology' in properties:
+                source = self._topologies.get(properties['topology'])
+                if source is None or 'layout' not in source:
+                    raise ValueError("Topology {!r} refers to unknown "
+                        "topology {!r}".format(name, properties['topology']))
+                continue
             if 'layout' not in properties:
                 continue
+            for g in properties.get('children', ()):
+                if g not in self._groups:
+                    raise ValueError("Topology {!r} refers to unknown "
+                                     "group {!r}".format(name, g))
+            for l in self.dependencies(name)[0]:
+                if l not in self._layout_data:
+                    raise ValueError("Topology {!r} refers to unknown "
+                                     "layout {!r}".format(name, l))
+
+    def closure(self, name):
+        """Returns names of topologies to build along with the named one
+
+        These are the topology having layout (the named one, or the one
+        extern topology is made of) followed by extern topologies using it
+        """
+        source = self._topologies[name].get('topology', name)
+        return [source] + [n for n, properties in self._topologies.items()
+                           if properties.get('topology') == source]
+
+    def build(self, name, built):
+        """Builds single topology
+
+        Extern topology is made of the topology found in ``built`` dict
+        """
+        properties = dict(self._topologies[name])
+        if 'topology' in properties:
+            top = ExternTopology(name, properties.pop('type'))
+            self._populate_from(top, built[properties.pop('topology')],
+                                **properties)
+        else:
             top = Topology(name, properties.pop('type'))
+            self._layouts = {}
             self._populate_for_layout(top, **properties)
-            topologies[name] = top
-            yield name, top
-        # The process extern topologies
-        for name, properties in self._topologies.items():
-            if 'topology' not in properties:
-                continue
-            top = ExternTopology(name, properties.pop('type'))
-            self._populate_from(top,
-                topologies[properties.pop('topology')],
-                **properties)
-            yield name, top
+        finalize(top)
+        return top
+
+    def topologies(self, reuse=None):
+        """Builds topologies, yields ``(name, topology)`` pairs
+
+        Topologies found in ``reuse`` dict are yielded instead of rebuilt
+        """
+        reuse = reuse or {}
+        topologies = {}
+        # First made topologies having layout, then extern topologies
+        for kind in ('layout', 'topology'):
+            for name, properties in self._topologies.items():
+                if kind not in properties:
+                    continue
+                top = reuse.get(name)
+                if top is None:
+                    top = self.build(name, topologies)
+                topologies[name] = top
+                yield name, top
@@ -0,0 +1,228 @@
+"""
+    Client of the name service with local cache and offline fallback
+"""
+import sys
+import time
+import argparse
+import threading
+
+from .db import Database, ReplyCache
+from .url import parse_url
+
+
+def _nanomsg():
+    """Imports nanomsg binding, raises OSError if the library isn't found"""
+    try:
+        from . import nanomsg
+    except AttributeError:
+        # raised by the binding when looking up functions of missing library
+        raise OSError("nanomsg library is not available")
+    return nanomsg
+
+
+class _Flight(object):
+    """Request in flight, other threads asking the same key wait for it"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Client(object):
+    """Resolves addresses by ``REQUEST`` to the name service at ``addr``
+
+    Answers are cached for ``ttl`` seconds. Threads asking for the same key
+    at the same time share a single request.
+
+    Errors replied by the server (``ERROR <kind>``) are raised as
+    ``LookupError("Name service error", kind)`` and aren't cached.
+
+    If the server doesn't answer within ``timeout`` seconds, or nanomsg is
+    not available, addresses are resolved locally by a database read from
+    ``files`` and ``snapshots``. The database is built lazily on the first
+    failure, and its answers are cached for ``retry`` seconds only, so the
+    server is asked again soon. Without files and snapshots the expired
+    answer is returned if there is one, otherwise the error is raised.
+
+    With ``subscribe()`` cached answers are also dropped as soon as the
+    server publishes that their topology has changed.
+    """
+
+    def __init__(self, addr, *, ttl=60, timeout=1.0, files=(), snapshots=(),
+                 retry=5, cache_size=4096):
+        self.addr = addr
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry = min(retry, ttl)
+        self.files = list(files)
+        self.snapshots = list(snapshots)
+        self.cache = ReplyCache(cache_size)
+        self.requests = 0
+        self.fallbacks = 0
+        # topology name -> last generation published by server
+        self.generations = {}
+        self._epoch = 0  # incremented on every invalidation
+        self._db = None
+        self._sock = None
+        self._lock = threading.Lock()
+        self._sock_lock = threading.Lock()
+        self._inflight = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._sock_lock:
+            if self._sock is not None:
+                from . import nanomsg
+                nanomsg.lib.nn_close(self._sock)
+                self._sock = None
+
+    def resolve(self, host, appname, topology_url, socktype):
+        """Returns tuple of address lines, like ``Database.resolve`` yields
+
+        ``None`` host and appname are sent as ``-``
+        """
+        key = (host or '-', appname or '-', topology_url, socktype)
+        now = time.monotonic()
+        with self._lock:
+            entry = self.cache.get(key, lambda entry: entry[0] > now)
+            if entry is not None:
+                return entry[1]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            epoch = self._epoch
+            stale = self.cache.peek(key)
+            if stale is not None:
+                stale = stale[1]
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            result, ttl = self._fetch(key, stale)
+            with self._lock:
+                # Answer may predate a change published meanwhile
+                if ttl is not None and epoch == self._epoch:
+                    self.cache.put(key, (time.monotonic() + ttl, result))
+            flight.result = result
+            return result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+
+    def invalidate(self, topology):
+        """Drops cached answers for the topology"""
+        with self._lock:
+            self._epoch += 1
+            self.cache.discard(
+                lambda key: parse_url(key[2])[0] == topology)
+
+    def subscribe(self, addr, topologies=None):
+        """Starts a thread invalidating cache on notices published at ``addr``
+
+        Subscribes to named ``topologies`` only, or to all if None. Notices
+        may be lost, e.g. when connection is being established, so ``ttl``
+        still bounds how long a stale answer may be served.
+        """
+        from . import nanomsg
+
+        if topologies is None:
+            topics = [b'']
+        else:
+            topics = [name.encode('ascii') + b' ' for name in topologies]
+        thread = threading.Thread(target=nanomsg.subscribe_service,
+            args=(addr, topics, self._notified),
+            name='rulens-subscribe', daemon=True)
+        thread.start()
+        return thread
+
+    def _notified(self, buf):
+        name, _, generation = str(buf, 'ascii').partition(' ')
+        self.generations[name] = int(generation)
+        self.invalidate(name)
+
+    def _fetch(self, key, stale):
+        """Returns answer and seconds to cache it for, None to not cache"""
+        try:
+            reply = self._request(key)
+        except OSError:
+            if self.files or self.snapshots:
+                self.fallbacks += 1
+                return tuple(self._database().resolve(*key)), self.retry
+            if stale is None:
+                raise
+            return stale, None
+        if reply.startswith('ERROR '):
+            raise LookupError("Name service error", reply[len('ERROR '):])
+        # Empty reply is a valid answer: there is nothing to connect to
+        return tuple(reply.split('\n')) if reply else (), self.ttl
+
+    def _request(self, key):
+        nanomsg = _nanomsg()
+
+        req = 'REQUEST {} {} {} {}'.format(*key).encode('ascii')
+        with self._sock_lock:
+            if self._sock is None:
+                sock = nanomsg.lib.nn_socket(nanomsg.const.AF_SP,
+                                             nanomsg.const.REQ)
+                ms = int(self.timeout * 1000)
+                for opt in (nanomsg.const.SNDTIMEO, nanomsg.const.RCVTIMEO):
+                    nanomsg.setsockopt_int(sock,
+                        nanomsg.const.SOL_SOCKET, opt, ms)
+                nanomsg.lib.nn_connect(sock, self.addr.encode('ascii'))
+                self._sock = sock
+            self.requests += 1
+            nanomsg.send_msg(self._sock, req)
+            with nanomsg.recv_msg(self._sock) as msg:
+                return bytes(msg.buffer).decode('ascii')
+
+    def _database(self):
+        with self._sock_lock:
+            if self._db is None:
+                db = Database(lazy=True)
+                for i in self.snapshots:
+                    db.add_from_snapshot(i)
+                # Read in this process: a pool would start processes
+                # from the threads of the application the client is in
+                db.add_from_files(self.files, processes=1)
+                self._db = db
+            return self._db
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('addr',
+        help="The nanomsg address of the name service")
+    ap.add_argument('query', nargs=4,
+        metavar=('HOST', 'APPNAME', 'TOPOLOGY', 'SOCKTYPE'),
+        help="Request to resolve, `-` for no host or appname")
+    ap.add_argument('-f', '--fallback', default=[], action='append',
+        help="Topology file to resolve from if service is unavailable")
+    ap.add_argument('-s', '--snapshot', default=[], action='append',
+        help="Snapshot to resolve from if service is unavailable")
+    ap.add_argument('--timeout', type=float, default=1.0,
+        help="Seconds to wait for the name service")
+    options = ap.parse_args()
+
+    with Client(options.addr, timeout=options.timeout,
+                files=options.fallback, snapshots=options.snapshot) as cli:
+        for line in cli.resolve(*options.query):
+            print(line)
+        if cli.fallbacks:
+            print("rulens: Resolved locally", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+    The command-line interface for compiling topology files into a snapshot
+    which name service may load on startup instead of the YAML
+"""
+import os
+import argparse
+
+from .db import Database
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('files', nargs='+',
+        help="Files to read topology from")
+    ap.add_argument('-o', '--output', required=True,
+        help="The snapshot file to write")
+    options = ap.parse_args()
+
+    db = Database()
+    db.add_from_files(options.files)
+
+    tmp = options.output + '.tmp'
+    with open(tmp, 'wb') as f:
+        db.dump_snapshot(f)
+    os.rename(tmp, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,356 @@
+import os
+import time
 import yaml
+import threading
 import pprint
+import multiprocessing
 import argparse
-from urllib.parse import urlparse, parse_qsl
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-from .builder import TopologyBuilder
+from . import snapshot
+from .url import parse_url
+from .builder import TopologyBuilder, node_key
+from .topology import ExternTopology
+
+
+def load_file(filename):
+    with open(filename, 'rt') as f:
+        return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader',
+                                           yaml.SafeLoader))
+
+
+def error_kind(exc):
+    """Returns short name of the resolve error for reporting"""
+    if isinstance(exc, AssertionError) and exc.args:
+        if exc.args == ("No rule for node",):
+            return 'no_rule'
+        if exc.args[0] == "No address for node":
+            return 'no_address'
+    return type(exc).__name__
+
+
+def _load(filename, lazy):
+    """Reads and builds the file in a worker process
+
+    Built topologies are passed back as a snapshot, ``None`` in lazy mode
+    """
+    data = load_file(filename)
+    bld = TopologyBuilder(data)
+    if lazy:
+        bld.check()
+        return data, None
+    return data, snapshot.dumps(dict(bld.topologies()))
+
+
+def _in_order(data, topologies):
+    """Orders dict of topologies like ``TopologyBuilder.topologies`` does"""
+    return {name: topologies[name]
+            for kind in ('layout', 'topology')
+            for name, properties in data['topologies'].items()
+            if kind in properties and name in topologies}
+
+
+def _rebuild(filename, state, built, lazy, preload=()):
+    """Reads the file again and builds topologies changed since ``state``
+
+    Topologies of ``built`` dict whose signature didn't change are reused,
+    the others are built: all of them, or only ``preload`` ones in lazy
+    mode. Returns new data, names of topologies to reuse and dict of the
+    topologies built.
+    """
+    data = load_file(filename)
+    old = TopologyBuilder(state)
+    bld = TopologyBuilder(data)
+    topologies = data['topologies']
+    reuse = {name for name in built if name in topologies
+             and bld.signature(name) == old.signature(name)}
+    if lazy:
+        bld.check()
+        wanted = [n for name in preload if name in topologies
+                  for n in bld.closure(name)]
+    else:
+        wanted = _in_order(data, dict.fromkeys(topologies))
+    available = {}  # topologies extern ones may be made of
+    new = {}
+    for name in wanted:
+        if name in reuse or name in new:
+            continue
+        source = topologies[name].get('topology')
+        if source is not None and source not in available:
+            top = built.get(source)
+            if top is None:  # reused, but not passed to child process
+                top = bld.build(source, available)
+            available[source] = top
+        new[name] = available[name] = bld.build(name, available)
+    return data, reuse, new
+
+
+def _reload(filename, state, names, lazy, preload):
+    """Runs ``_rebuild`` in a child process
+
+    Built topologies are passed back as a snapshot. Extern topologies made
+    of a reused topology get their own copy of its nodes.
+    """
+    data, reuse, new = _rebuild(filename, state, dict.fromkeys(names),
+                                lazy, preload)
+    return data, reuse, snapshot.dumps(new)
+
+
+def _address_index(top):
+    """Returns dict of address -> ``[(kind, priority, nodes)]`` of topology"""
+    index = defaultdict(list)
+    seen = set()
+    for nodes in top.rules.values():
+        for node in nodes:
+            for conns in node.connections.values():
+                for conn in conns:
+                    if conn in seen:
+                        continue
+                    seen.add(conn)
+                    for group, line in conn.endpoints():
+                        kind, priority, addr = line.split(':', 2)
+                        index[addr].append((kind, int(priority), group))
+    return dict(index)
+
+
+class ReplyCache(object):
+    """Bounded LRU cache of encoded replies"""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, fresh=None):
+        """Returns cached value, None if there is none
+
+        Values for which ``fresh(value)`` is false are counted as misses and
+        not returned, but are kept (see ``peek``)
+        """
+        value = self._data.get(key)
+        if value is None or fresh is not None and not fresh(value):
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Returns cached value or None, without counting or refreshing it"""
+        return self._data.get(key)
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, predicate):
+        """Removes entries whose key matches predicate"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
 
 
 class Database(object):
+    """Topologies to resolve names in
+
+    In ``lazy`` mode files are only parsed and checked when added, and each
+    topology is built on the first request naming it, along with extern
+    topologies made of the same one (see ``TopologyBuilder.closure``). The
+    ``topologies`` dict holds the ones built so far.
+    """
 
-    def __init__(self):
+    def __init__(self, cache_size=4096, *, lazy=False):
+        self.lazy = lazy
         self.topologies = {}
+        self.cache = ReplyCache(cache_size)
+        # Names of topologies built by this database rather than shared
+        # with the one it's reloaded from
+        self.rebuilt = set()
+        # (kind, filename, data or mtime, built topologies) in order added
+        self._sources = []
+        # name -> (builder, built topologies of the file) for lazy mode
+        self._pending = {}
+        self._lock = threading.Lock()
+        # name -> file topology is defined in
+        self._origins = {}
+        # topology name -> address index, see who()
+        self._addresses = {}
+        self._fingerprints = {}
 
-    def resolve(self, host, appname, topology_url, socktype):
-        url = urlparse(topology_url)
-        topology = self.topologies[url.netloc]
-        params = dict(parse_qsl(url.query))
+    def _topology(self, name):
+        top = self.topologies.get(name)
+        if top is None:
+            top = self._build(name)
+        return top
+
+    def _build(self, name):
+        with self._lock:
+            top = self.topologies.get(name)
+            if top is not None:  # built by another thread meanwhile
+                return top
+            bld, built = self._pending[name]
+            new = []
+            for n in bld.closure(name):
+                if n not in built:
+                    built[n] = bld.build(n, built)
+                if self._pending.pop(n, None) is not None:
+                    self.topologies[n] = built[n]
+                    new.append(n)
+            self.rebuilt.update(new)
+            self._index(new)
+            return self.topologies[name]
+
+    def _index(self, names):
+        for name in names:
+            top = self.topologies[name]
+            # nodes of extern topologies belong to their source
+            if not isinstance(top, ExternTopology):
+                self._addresses[name] = _address_index(top)
+
+    def preload(self, names=None):
+        """Builds named topologies (all of them if None) in lazy mode"""
+        if names is None:
+            names = list(self._pending)
+        for name in names:
+            self._topology(name)
+
+    def _parse_url(self, topology_url):
+        name, params = parse_url(topology_url)
+        return self._topology(name), params
+
+    def _resolve_node(self, host, appname, topology_url):
+        topology, params = self._parse_url(topology_url)
         params.update(dict(host=host, appname=appname))
         node = topology.resolve_node(params.get('role', None), params)
+        return topology, node, params
+
+    def resolve(self, host, appname, topology_url, socktype):
+        topology, node, params = self._resolve_node(
+            host, appname, topology_url)
         party = topology.party_mapping[socktype]
         for conn in node.connections[party]:
             yield from conn.address_for(node, params)
 
+    def resolve_reply(self, host, appname, topology_url, socktype,
+                      timings=None, nodes=None):
+        """Returns addresses encoded as a reply of the name service
+
+        Replies are cached unless some connection picks addresses randomly.
+        If ``timings`` dict is passed, it's filled with ``cache_hit`` flag
+        and ``resolve`` and ``encode`` durations in nanoseconds. The
+        ``nodes`` dict, if passed, keeps resolved nodes for the next calls.
+        """
+        key = (host, appname, topology_url, socktype)
+        reply = self.cache.get(key)
+        if reply is not None:
+            if timings is not None:
+                timings['cache_hit'] = True
+            return reply
+        if timings is not None:
+            start = time.perf_counter_ns()
+        found = None if nodes is None else nodes.get(key[:3])
+        if found is None:
+            found = self._resolve_node(host, appname, topology_url)
+            if nodes is not None:
+                nodes[key[:3]] = found
+        topology, node, params = found
+        conns = node.connections[topology.party_mapping[socktype]]
+        result = []
+        for conn in conns:
+            result.extend(conn.address_for(node, params))
+        if timings is not None:
+            resolved = time.perf_counter_ns()
+        reply = '\n'.join(result).encode('ascii')
+        if timings is not None:
+            timings['resolve'] = resolved - start
+            timings['encode'] = time.perf_counter_ns() - resolved
+        if all(conn.deterministic for conn in conns):
+            self.cache.put(key, reply)
+        return reply
+
+    def fingerprint(self, host, appname, topology_url, socktype):
+        """Returns value equal for databases answering the request the same
+
+        It's made of the node resolved and fingerprints of its connection
+        instances, which are computed once, so comparing databases this way
+        is cheaper than resolving
+        """
+        topology, node, params = self._resolve_node(
+            host, appname, topology_url)
+        result = [node.name, node_key(node)]
+        for conn in node.connections[topology.party_mapping[socktype]]:
+            fp = self._fingerprints.get(conn)
+            if fp is None:
+                fp = self._fingerprints[conn] = conn.fingerprint()
+            result.append(fp)
+        return tuple(result)
+
+    def resolve_many(self, queries, timings=None):
+        """Returns encoded replies for ``(host, appname, topology_url,
+        socktype)`` tuples
+
+        Replies are in the order of queries, a failed query is given by the
+        exception raised. Replies are cached just like by ``resolve_reply``,
+        and each distinct node is resolved once per batch. If ``timings``
+        list is passed, a timings dict of each query is appended to it.
+        """
+        nodes = {}
+        result = []
+        for query in queries:
+            qtimings = None if timings is None else {}
+            try:
+                result.append(self.resolve_reply(*query,
+                    timings=qtimings, nodes=nodes))
+            except Exception as e:
+                result.append(e)
+            if timings is not None:
+                timings.append(qtimings)
+        return result
+
+    def who(self, address):
+        """Returns nodes binding and connecting to the address
+
+        Result is a list of ``(kind, priority, topology name, node)`` where
+        kind is ``bind`` or ``connect``. Topologies are indexed as they are
+        built, so in lazy mode only the ones built so far are looked at.
+        """
+        result = {}  # dicts are ordered sets
+        for name in list(self.topologies):
+            index = self._addresses.get(name)
+            if index is None:
+                continue
+            for kind, priority, nodes in index.get(address, ()):
+                for node in nodes:
+                    result[kind, priority, name, node] = None
+        return list(result)
+
+    def who_lines(self, address):
+        """Returns result of ``who`` as ``kind:priority:topology_url``"""
+        result = []
+        for kind, priority, topology, node in self.who(address):
+            props = dict(role=node.name)
+            props.update(node.properties)
+            query = '&'.join('{}={}'.format(k, v) for k, v in props.items())
+            result.append('{}:{}:topology://{}?{}'.format(
+                kind, priority, topology, query))
+        return result
+
     def get_group(self, host, appname, topology_url, socktype):
         """Finds a group by parameters, primarily for graph building"""
-        url = urlparse(topology_url)
-        topology = self.topologies[url.netloc]
-        params = dict(parse_qsl(url.query))
+        topology, params = self._parse_url(topology_url)
         params.update(dict(host=host, appname=appname))
         node = topology.resolve_node(params['role'], params)
         while node.parent:
@@ -33,22 +358,156 @@ class Database(object):
         return node.group
 
     def pretty_print(self):
+        self.preload()
         for top in self.topologies.values():
             print('--', top.name, '--')
             pprint.pprint(top.__dict__)
 
+    def _add(self, kind, filename, state, built, rebuilt, builder=None):
+        pending = []
+        if builder is not None:
+            pending = [name for name, properties in state['topologies'].items()
+                       if name not in built and ('layout' in properties
+                                                 or 'topology' in properties)]
+        for name in list(built) + pending:
+            if name in self._origins:
+                raise ValueError("Topology {!r} from {} is already defined "
+                    "in {}".format(name, filename, self._origins[name]))
+        for name in list(built) + pending:
+            self._origins[name] = filename
+        self._sources.append((kind, filename, state, built))
+        self.topologies.update(built)
+        for name in pending:
+            self._pending[name] = builder, built
+        self.rebuilt.update(rebuilt)
+        self._index(rebuilt)
+        self.cache.clear()
+
     def add_from_file(self, filename):
-        with open(filename, 'rt') as f:
-            data = yaml.load(f)
+        data = load_file(filename)
         self.groups = data['groups']
         bld = TopologyBuilder(data)
-        self.topologies.update(bld.topologies())
+        if self.lazy:
+            bld.check()
+            self._add('file', filename, data, {}, (), bld)
+        else:
+            built = dict(bld.topologies())
+            self._add('file', filename, data, built, built)
+
+    def add_from_files(self, filenames, processes=None):
+        """Adds topologies from files, read and built in parallel
+
+        Files are read by a pool of ``processes`` (number of cpus by default)
+        and merged in the order given
+        """
+        filenames = list(filenames)
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if min(processes, len(filenames)) <= 1:
+            for fn in filenames:
+                self.add_from_file(fn)
+            return
+        # Children are spawned, as the caller may have threads (e.g. the
+        # client falling back to local files), which fork doesn't copy
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(min(processes, len(filenames)),
+                                 mp_context=ctx) as pool:
+            results = list(pool.map(_load, filenames,
+                                    [self.lazy] * len(filenames)))
+        for filename, (data, buf) in zip(filenames, results):
+            self.groups = data['groups']
+            if buf is None:
+                self._add('file', filename, data, {}, (),
+                          TopologyBuilder(data))
+            else:
+                built = snapshot.loads(buf)
+                self._add('file', filename, data, built, built)
+
+    def add_from_snapshot(self, filename):
+        """Adds topologies from file written by ``python -m rulens.compile``"""
+        with open(filename, 'rb') as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            built = snapshot.loads(f.read())
+        self._add('snapshot', filename, mtime, built, built)
+
+    def reloaded(self, preload=(), pool=None):
+        """Returns new database with all the files read again
+
+        Only topologies whose definition, layouts or groups have changed are
+        rebuilt, along with extern topologies using them, the rest are
+        shared with this database. Snapshots are loaded again if modified.
+        In lazy mode, topologies which were not built yet stay so, except
+        ``preload`` ones.
+
+        Files are read and built by ``pool`` (an executor of processes), so
+        that building doesn't compete for the GIL with requests served by
+        this process, which only loads the built topologies. Without pool
+        everything is done in the calling thread.
+        """
+        jobs = []
+        for kind, filename, state, built in self._sources:
+            if kind == 'snapshot':
+                jobs.append((built, None))
+                continue
+            with self._lock:  # may be filled by lazy builds meanwhile
+                built = dict(built)
+            if pool is None:
+                job = _rebuild(filename, state, built, self.lazy, preload)
+            else:
+                job = pool.submit(_reload, filename, state, list(built),
+                                  self.lazy, tuple(preload))
+            jobs.append((built, job))
+
+        db = Database(cache_size=self.cache.size, lazy=self.lazy)
+        for (kind, filename, state, _), (built, job) in zip(self._sources,
+                                                             jobs):
+            if kind == 'snapshot':
+                if os.stat(filename).st_mtime_ns == state:
+                    db._add(kind, filename, state, built, ())
+                else:
+                    db.add_from_snapshot(filename)
+                continue
+            if pool is None:
+                data, reuse, new = job
+            else:
+                data, reuse, buf = job.result()
+                new = snapshot.loads(buf)
+            tops = {name: built[name] for name in reuse}
+            tops.update(new)
+            db.groups = data['groups']
+            db._add(kind, filename, data, _in_order(data, tops), new,
+                    TopologyBuilder(data) if self.lazy else None)
+        # shared topologies share address indexes too
+        for name, top in db.topologies.items():
+            index = self._addresses.get(name)
+            if (name not in db._addresses and index is not None
+                    and self.topologies.get(name) is top):
+                db._addresses[name] = index
+        return db
+
+    def changed(self, old):
+        """Returns names of topologies which may resolve differently in ``old``
+
+        Those are topologies added, removed or rebuilt since ``old``. In lazy
+        mode topologies not built in either database are skipped, as nothing
+        could be resolved from them yet.
+        """
+        return sorted(name for name in self._origins.keys() | old._origins
+                      if (name in self.topologies or name in old.topologies)
+                      and self.topologies.get(name)
+                          is not old.topologies.get(name))
+
+    def dump_snapshot(self, file):
+        self.preload()
+        file.write(snapshot.dumps(self.topologies))
 
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument('files', nargs='+',
+    ap.add_argument('files', nargs='*',
         help="Files to read topology from")
+    ap.add_argument('-s', '--snapshot', default=[], action='append',
+        help="Compiled snapshot to read topology from")
     ap.add_argument('--print-db', action='store_true', default=False,
         help="Print whole database and exit")
     ap.add_argument('--query', nargs=4,
@@ -57,8 +516,9 @@ def main():
     options = ap.parse_args()
 
     db = Database()
-    for i in options.files:
-        db.add_from_file(i)
+    for i in options.snapshot:
+        db.add_from_snapshot(i)
+    db.add_from_files(options.files)
 
     if options.print_db:
         db.pretty_print()
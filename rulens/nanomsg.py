@@ -1,32 +1,70 @@
+import errno
+import asyncio
 import ctypes.util
 from itertools import count
 
 
 def _rc_checker(rc, func, args):
     if rc == -1:
-        raise OSError(ctypes.get_errno())
+        err = lib.nn_errno()
+        raise OSError(err, lib.nn_strerror(err).decode('ascii'))
     return rc
 
 
+def _null_checker(ptr, func, args):
+    if ptr is None:
+        err = lib.nn_errno()
+        raise OSError(err, lib.nn_strerror(err).decode('ascii'))
+    return ptr
+
+
 lib = ctypes.CDLL(ctypes.util.find_library('nanomsg'))
 NN_MSG = (1 << (8*ctypes.sizeof(ctypes.c_size_t))) - 1
 
+lib.nn_errno.argtypes = []
+lib.nn_errno.restype = ctypes.c_int
+lib.nn_strerror.argtypes = [ctypes.c_int]
+lib.nn_strerror.restype = ctypes.c_char_p
+
 lib.nn_symbol.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
 lib.nn_symbol.restype = ctypes.c_char_p
 lib.nn_socket.argtypes = [ctypes.c_int, ctypes.c_int]
 lib.nn_socket.restype = ctypes.c_int
 lib.nn_socket.errcheck = _rc_checker
-lib.nn_recv.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_uint64),
+lib.nn_close.argtypes = [ctypes.c_int]
+lib.nn_close.restype = ctypes.c_int
+lib.nn_close.errcheck = _rc_checker
+lib.nn_recv.argtypes = [ctypes.c_int, ctypes.c_void_p,
                         ctypes.c_size_t, ctypes.c_int]
 lib.nn_recv.restype = ctypes.c_int
 lib.nn_recv.errcheck = _rc_checker
-lib.nn_send.argtypes = [ctypes.c_int, ctypes.c_char_p,
+lib.nn_send.argtypes = [ctypes.c_int, ctypes.c_void_p,
                         ctypes.c_size_t, ctypes.c_int]
 lib.nn_send.restype = ctypes.c_int
 lib.nn_send.errcheck = _rc_checker
+lib.nn_allocmsg.argtypes = [ctypes.c_size_t, ctypes.c_int]
+lib.nn_allocmsg.restype = ctypes.c_void_p
+lib.nn_allocmsg.errcheck = _null_checker
+lib.nn_freemsg.argtypes = [ctypes.c_void_p]
+lib.nn_freemsg.restype = ctypes.c_int
+lib.nn_freemsg.errcheck = _rc_checker
 lib.nn_bind.argtypes = [ctypes.c_int, ctypes.c_char_p]
 lib.nn_bind.restype = ctypes.c_int
 lib.nn_bind.errcheck = _rc_checker
+lib.nn_connect.argtypes = [ctypes.c_int, ctypes.c_char_p]
+lib.nn_connect.restype = ctypes.c_int
+lib.nn_connect.errcheck = _rc_checker
+lib.nn_device.argtypes = [ctypes.c_int, ctypes.c_int]
+lib.nn_device.restype = ctypes.c_int
+lib.nn_device.errcheck = _rc_checker
+lib.nn_getsockopt.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t)]
+lib.nn_getsockopt.restype = ctypes.c_int
+lib.nn_getsockopt.errcheck = _rc_checker
+lib.nn_setsockopt.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_void_p, ctypes.c_size_t]
+lib.nn_setsockopt.restype = ctypes.c_int
+lib.nn_setsockopt.errcheck = _rc_checker
 
 
 class Const:
@@ -46,11 +84,226 @@ class Const:
 const = Const()
 
 
-def reply_service(bind, callback):
-    ptr = ctypes.c_uint64()
-    sock = lib.nn_socket(const.AF_SP, const.REP)
-    lib.nn_bind(sock, bind.encode('ascii'))
+class Message(object):
+    """The message received into a buffer allocated by nanomsg
+
+    The ``buffer`` is a memoryview of the nanomsg chunk itself. It's released
+    along with the chunk by ``free()`` (or on exit from ``with`` block), so
+    it must not be referenced afterwards.
+    """
+
+    def __init__(self, ptr, size):
+        self._ptr = ptr
+        self.buffer = memoryview(
+            (ctypes.c_char * size).from_address(ptr)).cast('B')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.free()
+
+    def free(self):
+        if self._ptr is not None:
+            self.buffer.release()
+            lib.nn_freemsg(self._ptr)
+            self._ptr = None
+
+
+def getsockopt_int(sock, level, option):
+    val = ctypes.c_int()
+    size = ctypes.c_size_t(ctypes.sizeof(val))
+    lib.nn_getsockopt(sock, level, option,
+                      ctypes.byref(val), ctypes.byref(size))
+    return val.value
+
+
+def setsockopt_int(sock, level, option, value):
+    val = ctypes.c_int(value)
+    lib.nn_setsockopt(sock, level, option,
+                      ctypes.byref(val), ctypes.sizeof(val))
+
+
+def setsockopt_bytes(sock, level, option, value):
+    lib.nn_setsockopt(sock, level, option, value, len(value))
+
+
+def recv_msg(sock, flags=0):
+    ptr = ctypes.c_void_p()
+    size = lib.nn_recv(sock, ctypes.byref(ptr), NN_MSG, flags)
+    return Message(ptr.value, size)
+
+
+def send_msg(sock, data, flags=0):
+    """Sends bytes, nanomsg copies them into a chunk of its own
+
+    Sending an ``nn_allocmsg`` chunk wouldn't save the copy: the chunk is
+    owned by nanomsg after send, while replies are kept in the cache
+    """
+    return lib.nn_send(sock, data, len(data), flags)
+
+
+def _restarting(func, *args):
+    """Calls function again if it's interrupted by a signal
+
+    Python signal handlers have already run when exception is caught here
+    """
     while True:
-        rc = lib.nn_recv(sock, ctypes.byref(ptr), NN_MSG, 0)
-        reply = callback(ctypes.string_at(ptr.value, rc))
-        lib.nn_send(sock, reply, len(reply), 0)
+        try:
+            return func(*args)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+def reply_service(addr, callback, *, connect=False):
+    """Serves requests by callback
+
+    The callback gets a memoryview of the request, which is valid only until
+    callback returns, and must return a bytes-like reply
+    """
+    sock = lib.nn_socket(const.AF_SP, const.REP)
+    try:
+        if connect:
+            lib.nn_connect(sock, addr.encode('ascii'))
+        else:
+            lib.nn_bind(sock, addr.encode('ascii'))
+        while True:
+            with _restarting(recv_msg, sock) as msg:
+                reply = callback(msg.buffer)
+            _restarting(send_msg, sock, reply)
+    finally:
+        lib.nn_close(sock)
+
+
+class AsyncSocket(object):
+    """Non-blocking socket waiting on NN_RCVFD/NN_SNDFD in asyncio loop"""
+
+    def __init__(self, domain, protocol):
+        self.sock = lib.nn_socket(domain, protocol)
+        self._rcvfd = None
+        self._sndfd = None
+
+    def bind(self, addr):
+        return lib.nn_bind(self.sock, addr.encode('ascii'))
+
+    def connect(self, addr):
+        return lib.nn_connect(self.sock, addr.encode('ascii'))
+
+    def close(self):
+        if self.sock is not None:
+            lib.nn_close(self.sock)
+            self.sock = None
+
+    async def recv(self):
+        """Receives a ``Message``, which must be freed by the caller"""
+        while True:
+            try:
+                return recv_msg(self.sock, const.DONTWAIT)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            if self._rcvfd is None:
+                self._rcvfd = getsockopt_int(self.sock,
+                    const.SOL_SOCKET, const.RCVFD)
+            await _readable(self._rcvfd)
+
+    async def send(self, data):
+        while True:
+            try:
+                return send_msg(self.sock, data, const.DONTWAIT)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            if self._sndfd is None:
+                self._sndfd = getsockopt_int(self.sock,
+                    const.SOL_SOCKET, const.SNDFD)
+            await _readable(self._sndfd)
+
+
+async def _readable(fd):
+    # Both NN_RCVFD and NN_SNDFD signal readiness by becoming readable
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    loop.add_reader(fd, lambda: fut.done() or fut.set_result(None))
+    try:
+        await fut
+    finally:
+        loop.remove_reader(fd)
+
+
+async def async_reply_service(addr, callback, *, connect=False):
+    """Same as ``reply_service`` but runs in asyncio event loop"""
+    sock = AsyncSocket(const.AF_SP, const.REP)
+    try:
+        if connect:
+            sock.connect(addr)
+        else:
+            sock.bind(addr)
+        while True:
+            with await sock.recv() as msg:
+                reply = callback(msg.buffer)
+            await sock.send(reply)
+    finally:
+        sock.close()
+
+
+class Publisher(object):
+    """PUB socket bound to ``addr``
+
+    Messages are dropped if there are no subscribers or they are too slow
+    """
+
+    def __init__(self, addr):
+        self.sock = lib.nn_socket(const.AF_SP, const.PUB)
+        try:
+            lib.nn_bind(self.sock, addr.encode('ascii'))
+        except BaseException:
+            self.close()
+            raise
+
+    def publish(self, data):
+        _restarting(send_msg, self.sock, data)
+
+    def close(self):
+        if self.sock is not None:
+            lib.nn_close(self.sock)
+            self.sock = None
+
+
+def subscribe_service(addr, topics, callback):
+    """Calls callback for each message published to ``addr`` on ``topics``
+
+    Topics are prefixes of message, an empty one subscribes to every
+    message. The callback gets a memoryview valid until callback returns.
+    Blocks forever.
+    """
+    sock = lib.nn_socket(const.AF_SP, const.SUB)
+    try:
+        for topic in topics:
+            setsockopt_bytes(sock, const.SUB, const.SUB_SUBSCRIBE, topic)
+        lib.nn_connect(sock, addr.encode('ascii'))
+        while True:
+            with _restarting(recv_msg, sock) as msg:
+                callback(msg.buffer)
+    finally:
+        lib.nn_close(sock)
+
+
+def device(bind, backend):
+    """Forwards requests from ``bind`` to REP sockets connected to ``backend``
+
+    Both sockets are raw, so replies are routed back to the original
+    requester. Blocks forever.
+    """
+    front = lib.nn_socket(const.AF_SP_RAW, const.REP)
+    try:
+        back = lib.nn_socket(const.AF_SP_RAW, const.REQ)
+        try:
+            lib.nn_bind(front, bind.encode('ascii'))
+            lib.nn_bind(back, backend.encode('ascii'))
+            _restarting(lib.nn_device, front, back)
+        finally:
+            lib.nn_close(back)
+    finally:
+        lib.nn_close(front)
@@ -0,0 +1,125 @@
+"""
+    Rebuilding topology database while serving requests
+"""
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .db import Database
+
+
+class Reloader(object):
+    """Holds current database and rebuilds it in background
+
+    Only topologies affected by the change are rebuilt (see
+    ``Database.reloaded``), in child processes so that building doesn't
+    compete with the request loop for the GIL, then ``db`` attribute is
+    replaced. A request being served keeps using the database it has
+    started with. If anything fails, the old database keeps serving.
+
+    After each successful reload ``on_reload`` is called, if given, with the
+    new generation number and the names of topologies changed (see
+    ``Database.changed``).
+    """
+
+    def __init__(self, files, snapshots=(), *, cache_size=4096,
+                 lazy=False, preload=(), verbose=False, on_reload=None):
+        self.files = list(files)
+        self.snapshots = list(snapshots)
+        self.cache_size = cache_size
+        self.lazy = lazy
+        self.preload = list(preload)
+        self.verbose = verbose
+        self.on_reload = on_reload
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._again = False
+        self._mtimes = self._stat()
+        self.db = self._load(self.files)
+
+    def _stat(self):
+        mtimes = {}
+        for fn in self.files + self.snapshots:
+            try:
+                mtimes[fn] = os.stat(fn).st_mtime_ns
+            except OSError:
+                mtimes[fn] = None
+        return mtimes
+
+    def _load(self, files):
+        db = Database(cache_size=self.cache_size, lazy=self.lazy)
+        for i in self.snapshots:
+            db.add_from_snapshot(i)
+        db.add_from_files(files)
+        db.preload(self.preload)
+        return db
+
+    def _rebuild(self):
+        processes = min(len(self.files), os.cpu_count() or 1)
+        if not processes:
+            return self.db.reloaded(self.preload)
+        # Children are spawned rather than forked from a threaded process
+        with ProcessPoolExecutor(processes,
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+            return self.db.reloaded(self.preload, pool)
+
+    def reload(self):
+        """Starts rebuilding database in a thread, returns immediately
+
+        If a rebuild is already running, another one is started when it
+        finishes, so the latest files are always picked up
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._again = True
+                return
+            self._thread = threading.Thread(target=self._run,
+                name='rulens-reload', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                db = self._rebuild()
+                db.preload(self.preload)
+            except Exception as e:
+                print("rulens: Reload failed, keeping old database:",
+                    repr(e), file=sys.stderr)
+            else:
+                changed = db.changed(self.db)
+                self.db = db
+                self.generation += 1
+                if self.verbose:
+                    print("rulens: Database reloaded, generation",
+                          self.generation, "changed:",
+                          ', '.join(changed) or 'nothing')
+                if self.on_reload is not None:
+                    try:
+                        self.on_reload(self.generation, changed)
+                    except Exception as e:
+                        print("rulens: Reload notification failed:",
+                            repr(e), file=sys.stderr)
+            with self._lock:
+                if not self._again:
+                    self._thread = None
+                    return
+                self._again = False
+
+    def watch(self, interval):
+        """Starts a thread reloading database when files are modified"""
+        thread = threading.Thread(target=self._watch, args=(interval,),
+            name='rulens-watch', daemon=True)
+        thread.start()
+        return thread
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            mtimes = self._stat()
+            if mtimes != self._mtimes:
+                self._mtimes = mtimes
+                self.reload()
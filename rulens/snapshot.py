@@ -0,0 +1,309 @@
+"""
+    Compact binary snapshot of a built topology database
+
+    The snapshot is a marshalled set of flat tables (topologies, nodes,
+    connections, connection instances and rule indexes) referencing each
+    other by index. Everything computed when topology is finalized is
+    stored as well: reply lines, rule tables and hash rings of connection
+    instances, and rule indexes of topologies. So loading only makes the
+    objects, without parsing YAML, running the builder or formatting any
+    address.
+
+    Tables are marshalled in chunks, so that loading doesn't hold the GIL
+    for long, as snapshots are also loaded by the server serving requests.
+    Marshal format is only guaranteed to be readable by the same python
+    version, so snapshots should be compiled by the interpreter running the
+    name service.
+"""
+import gc
+import marshal
+from collections import defaultdict
+
+from .builder import Connection, ConnectionInstance, Node, SuperNode
+from .topology import Topology, ExternTopology, RuleIndex
+
+
+MAGIC = b'RULENS\x00\x03'
+CHUNK = 1024  # nodes referenced by the rows marshalled together
+TOPOLOGY_CLASSES = {cls.__name__: cls for cls in (Topology, ExternTopology)}
+
+
+class _Tables(object):
+    """Numbers objects in the order they are reached
+
+    Rows are filled from a queue rather than recursively, because chains
+    of nodes and connection instances may be very long
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.connections = []
+        self.infos = []
+        self.instances = []
+        self.indexes = []
+        self._node_ids = {}
+        self._connection_ids = {}
+        self._info_ids = {}
+        self._instance_ids = {}
+        self._queue = []
+
+    def node(self, node):
+        idx = self._node_ids.get(id(node))
+        if idx is None:
+            idx = self._node_ids[id(node)] = len(self.nodes)
+            self.nodes.append(None)
+            self._queue.append((self._node_row, self.nodes, idx, node))
+        return idx
+
+    def connections_of(self, node):
+        # frozen nodes share equal mappings, so are the rows
+        conns = node.connections
+        idx = self._connection_ids.get(id(conns))
+        if idx is None:
+            idx = self._connection_ids[id(conns)] = len(self.connections)
+            self.connections.append((
+                [self.instance(ci) for ci in conns['source']],
+                [self.instance(ci) for ci in conns['sink']],
+                ))
+        return idx
+
+    def info(self, info):
+        idx = self._info_ids.get(id(info))
+        if idx is None:
+            idx = self._info_ids[id(info)] = len(self.infos)
+            self.infos.append((info.source, info.sink, info.bound, {
+                'port': info.port,
+                'ports': info.ports,
+                'match_by': info.match_by,
+                'addr': info.addr,
+                'priority': info.priority,
+                'skip_same': info.skip_same,
+                }))
+        return idx
+
+    def instance(self, ci):
+        idx = self._instance_ids.get(id(ci))
+        if idx is None:
+            idx = self._instance_ids[id(ci)] = len(self.instances)
+            self.instances.append(None)
+            self._queue.append(
+                (self._instance_row, self.instances, idx, ci))
+        return idx
+
+    def index(self, index):
+        idx = len(self.indexes)
+        self.indexes.append(None)
+        self._queue.append((self._index_row, self.indexes, idx, index))
+        return idx
+
+    def flush(self):
+        while self._queue:
+            func, table, idx, obj = self._queue.pop()
+            table[idx] = func(obj)
+
+    def _node_row(self, node):
+        return (
+            node.name,
+            node.rules,
+            node.properties,
+            node.group,
+            None if node.parent is None else self.node(node.parent),
+            [self.node(ch) for ch in node.children]
+                if isinstance(node, SuperNode) else None,
+            self.connections_of(node),
+            )
+
+    def _index_row(self, index):
+        if index.key is None:
+            return (None, [(pos, None if req is node.properties else req,
+                            self.node(node))
+                           for pos, req, node in index.entries])
+        return (index.key,
+                {val: self.index(sub) for val, sub in index.buckets.items()},
+                None if index.wildcard is None
+                     else self.index(index.wildcard))
+
+    def _instance_row(self, ci):
+        return (
+            self.info(ci.info),
+            [self.node(n) for n in ci.sources],
+            [self.node(n) for n in ci.sinks],
+            {
+                'match_by': ci.match_by,
+                'rules': list(ci.rules),
+                'default': ci.default,
+                'hash_by': ci.hash_by,
+            },
+            None if ci._bind is None else self._materialized(ci))
+
+    def _materialized(self, ci):
+        """Returns state made by ``ConnectionInstance.materialize``"""
+        hashing = None
+        if hasattr(ci, '_ring_points'):
+            hashing = ('ring', ci._ring_points,
+                       [self.node(n) for n in ci._ring_nodes])
+        elif hasattr(ci, '_weighted'):
+            hashing = ('rendezvous', [(key, weight, self.node(n))
+                                      for key, weight, n in ci._weighted])
+        return (
+            [ci._bind[n] for n in ci._bound],
+            [ci._connect[n] for n in ci._bound],
+            ci._connect_all,
+            {value: [self.node(n) for n in nodes]
+             for value, nodes in ci._routes.items()},
+            hashing,
+            )
+
+
+def dumps(topologies):
+    """Serializes dict of finalized topologies to bytes"""
+    tables = _Tables()
+    tops = []
+    for name, top in topologies.items():
+        tops.append((name, top.__class__.__name__, top.type,
+            {role: [tables.node(n) for n in nodes]
+             for role, nodes in top.rules.items()},
+            {role: tables.index(index)
+             for role, index in top._index.items()}))
+    tables.flush()
+    chunks = {
+        'nodes': _chunks(tables.nodes),
+        'connections': _chunks(tables.connections,
+                               lambda row: len(row[0]) + len(row[1])),
+        'infos': _chunks(tables.infos),
+        'instances': _chunks(tables.instances,
+                             lambda row: len(row[1]) + len(row[2])),
+        'indexes': _chunks(tables.indexes, lambda row: len(row[1])),
+        }
+    return MAGIC + marshal.dumps((tops, chunks))
+
+
+def _chunks(rows, size=lambda row: 1):
+    """Marshals rows in chunks of about ``CHUNK`` in total size"""
+    result = []
+    chunk = []
+    total = 0
+    for row in rows:
+        chunk.append(row)
+        total += 1 + size(row)
+        if total >= CHUNK:
+            result.append(marshal.dumps(chunk))
+            chunk = []
+            total = 0
+    if chunk:
+        result.append(marshal.dumps(chunk))
+    return result
+
+
+def _restore(ci, state, nodes):
+    bind, connect, connect_all, routes, hashing = state
+    info = ci.info
+    bound = ci.sources if info.bound == info.source else ci.sinks
+    ci._bound = bound
+    ci._connect = dict(zip(bound, connect))
+    ci._connect_all = connect_all
+    ci._routes = {value: [nodes[i] for i in indices]
+                  for value, indices in routes.items()}
+    if hashing is not None:
+        if hashing[0] == 'ring':
+            ci._ring_points = hashing[1]
+            ci._ring_nodes = [nodes[i] for i in hashing[2]]
+        else:
+            ci._weighted = [(key, weight, nodes[i])
+                            for key, weight, i in hashing[1]]
+    # Assigned last, as it marks instance materialized
+    ci._bind = dict(zip(bound, bind))
+
+
+def _indexes(rows, nodes):
+    indexes = [RuleIndex.__new__(RuleIndex) for _ in rows]
+    for index, row in zip(indexes, rows):
+        index.key = row[0]
+        if index.key is None:
+            entries = []
+            for pos, req, i in row[1]:
+                node = nodes[i]
+                entries.append((pos, node.properties if req is None else req,
+                                node))
+            index.entries = entries
+            continue
+        _, buckets, wildcard = row
+        index.entries = None
+        index.buckets = {val: indexes[i] for val, i in buckets.items()}
+        index.wildcard = None if wildcard is None else indexes[wildcard]
+    return indexes
+
+
+def _rows(chunks):
+    rows = []
+    for chunk in chunks:
+        rows.extend(marshal.loads(chunk))
+    return rows
+
+
+def loads(buf):
+    """Restores dict of topologies from buffer made by ``dumps``
+
+    Objects are made directly from the stored state, nothing is recomputed
+    """
+    # All the objects made are kept, so collecting garbage while they are
+    # made only walks the whole heap a few times for nothing
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _loads(buf)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _loads(buf):
+    with memoryview(buf) as view:
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError("Not a rulens snapshot of this version")
+        tops, chunks = marshal.loads(view[len(MAGIC):])
+    node_rows = _rows(chunks['nodes'])
+    connection_rows = _rows(chunks['connections'])
+    info_rows = _rows(chunks['infos'])
+    instance_rows = _rows(chunks['instances'])
+
+    nodes = []
+    for name, rules, properties, group, _, children, _ in node_rows:
+        node = Node.__new__(Node if children is None else SuperNode)
+        node.group = group
+        node.name = name
+        node.rules = rules
+        node.properties = properties
+        node.parent = None
+        nodes.append(node)
+    infos = [Connection(source, sink, bound, **kw)
+             for source, sink, bound, kw in info_rows]
+    instances = []
+    for info, sources, sinks, kw, state in instance_rows:
+        ci = ConnectionInstance(infos[info],
+                                [nodes[i] for i in sources],
+                                [nodes[i] for i in sinks], **kw)
+        if state is not None:
+            _restore(ci, state, nodes)
+        instances.append(ci)
+    connections = [{'source': tuple(instances[i] for i in sources),
+                    'sink': tuple(instances[i] for i in sinks)}
+                   for sources, sinks in connection_rows]
+    for node, row in zip(nodes, node_rows):
+        _, _, _, _, parent, children, conns = row
+        if parent is not None:
+            node.parent = nodes[parent]
+        if children is not None:
+            node.children = tuple(nodes[i] for i in children)
+        node.connections = connections[conns]
+    indexes = _indexes(_rows(chunks['indexes']), nodes)
+
+    result = {}
+    for name, clsname, type, rules, roots in tops:
+        top = TOPOLOGY_CLASSES[clsname](name, type)
+        top.rules = defaultdict(list, {
+            role: [nodes[i] for i in indices]
+            for role, indices in rules.items()})
+        top._index = {role: indexes[i] for role, i in roots.items()}
+        result[name] = top
+    return result
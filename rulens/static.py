@@ -3,16 +3,16 @@
 """
 import argparse
 import sys
+import os
 import io
+import json
 import subprocess
-import yaml
-from urllib.parse import urlparse, parse_qsl
+import multiprocessing
 from contextlib import contextmanager
 from collections import defaultdict
-from itertools import product
-from functools import partial
 
-from .db import Database
+from .db import Database, load_file, error_kind
+from .url import parse_url
 
 
 @contextmanager
@@ -24,53 +24,231 @@ def set_stdout(file):
     finally:
         sys.stdout = oldstdout
 
-def draw_instance_graph(options, db):
-    hosts = defaultdict(partial(defaultdict, dict))
-    devices = set()
-    conn = defaultdict(list)
-    bind = defaultdict(list)
-    priorities = set()
-    counter = 0
-    for fn in options.list_file:
+# Database shared with worker processes, which are forked
+_db = None
+
+
+def read_list_files(filenames):
+    """Yields ``(filename, line number, line)`` of requests in list files"""
+    for fn in filenames:
         with open(fn, 'rt') as file:
-            for line in file:
+            for num, line in enumerate(file, 1):
                 line = line.strip()
-                if line.startswith('#'):  # comment
+                if line and not line.startswith('#'):
+                    yield fn, num, line
+
+
+def map_lines(options, db, func):
+    """Yields results of ``func`` for lines of list files in input order
+
+    Lines are processed by ``options.jobs`` forked processes
+    """
+    global _db
+    _db = db
+    items = read_list_files(options.list_file)
+    if options.jobs <= 1:
+        yield from map(func, items)
+        return
+    pool = multiprocessing.get_context('fork').Pool(options.jobs)
+    try:
+        yield from pool.imap(func, items, chunksize=256)
+    finally:
+        pool.terminate()
+
+
+def socktypes_for(nodetype):
+    if nodetype == 'device':
+        return ('NN_REQ', 'NN_REP')
+    return (nodetype,)
+
+
+def graph_line(item):
+    """Resolves a line of list file for the instance graph
+
+    Returns node name, its group, query and list of endpoints, which are
+    ``(kind, priority, address)`` tuples
+    """
+    fn, num, line = item
+    url, nodetype = line.split()
+    socktypes = socktypes_for(nodetype)
+    _, query = parse_url(url)
+    nname = '{0[hostname]}_{0[role]}_{0[pid]}'.format(query)
+    group = _db.get_group(None, None, url, socktypes[0])
+    endpoints = []
+    for socktype in socktypes:
+        for addr in _db.resolve(None, None, url, socktype):
+            kind, priority, raddr = addr.split(':', 2)
+            if socktype == 'NN_REQ':  # TODO(pc) other types!
+                priority = int(priority)
+            else:
+                priority = None
+            if kind not in ('bind', 'connect'):
+                raise AssertionError("Wrong address {!r}".format(addr))
+            endpoints.append((kind, priority, raddr))
+    return nname, group, query, nodetype == 'device', endpoints
+
+
+class InstanceGraph(object):
+    """Joins endpoints of nodes by address as nodes are added
+
+    Edge is passed to the writer as soon as both its endpoints are known,
+    going from the requesting side (having priority) to the replying one.
+    Bound addresses nobody connects to are written as external endpoints by
+    ``finish``.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        # address -> ordered set of bound (priority, node), list of connected
+        self._bind = defaultdict(dict)
+        self._connect = defaultdict(list)
+
+    def add_node(self, name, group, props, device, endpoints):
+        self.writer.node(name, group, props, device)
+        for kind, priority, addr in endpoints:
+            if kind == 'bind':
+                binds = self._bind[addr]
+                if (priority, name) in binds:
                     continue
-                url, nodetype = line.split()
-                if nodetype == 'device':
-                    socktypes = ('NN_REQ', 'NN_REP')
-                u = urlparse(url)
-                query = dict(parse_qsl(u.query))
-                nname = '{0[hostname]}_{0[role]}_{0[pid]}'.format(query)
-                if nodetype == 'device':
-                    devices.add(nname)
-                group = db.get_group(None, None, url, socktypes[0])
-                hosts[group][query['hostname']][nname] = query
-                for socktype in socktypes:
-                    for addr in db.resolve(None, None, url, socktype):
-                        kind, priority, raddr = addr.split(':', 2)
-                        if socktype == 'NN_REQ':  # TODO(pc) other types!
-                            priority = int(priority)
-                            priorities.add(priority)
-                        else:
-                            priority = None
-                        if kind == 'bind':
-                            bind[raddr].append((priority, nname))
-                        elif kind == 'connect':
-                            conn[raddr].append((priority, nname))
-                        else:
-                            raise AssertionError(
-                                "Wrong address {!r}".format(addr))
-    priority_styles = ['dotted', 'dashed', 'solid']
-    priority_lengths = [0, 0, 1]
-    priostyles = {None: 'solid'}
-    priolengths = {None: 1}
-    for i in sorted(priorities):
-        priostyles[i] = priority_styles.pop()
-        priolengths[i] = priority_lengths.pop()
+                binds[priority, name] = None
+                for peer in self._connect.get(addr, ()):
+                    self._edge(addr, (priority, name), peer)
+            else:
+                self._connect[addr].append((priority, name))
+                for peer in self._bind.get(addr, ()):
+                    self._edge(addr, peer, (priority, name))
 
-    if options.raw:
+    def _edge(self, addr, bound, connected):
+        (pa, a), (pb, b) = bound, connected
+        if pa is not None:
+            self.writer.edge(a, b, addr, pa, reverse=False)
+        else:
+            self.writer.edge(b, a, addr, pb, reverse=True)
+
+    def finish(self):
+        unbound = [addr for addr in self._connect if addr not in self._bind]
+        for addr, binds in self._bind.items():
+            if addr not in self._connect:
+                for priority, name in binds:
+                    self.writer.external(name, addr, priority)
+        self.writer.finish()
+        if unbound:
+            raise ValueError("Nobody binds {}".format(', '.join(unbound)))
+
+
+class DotWriter(object):
+    """Writes instance graph in graphviz format
+
+    Subgraphs of groups and hosts are reopened for every node, which
+    graphviz merges. Line styles are given to ``priorities`` in ascending
+    order, as they need to be known before any edge is written.
+    """
+
+    def __init__(self, priorities):
+        styles = ['dotted', 'dashed', 'solid']
+        lengths = [0, 0, 1]
+        self.styles = {None: ('solid', 1)}
+        for i in sorted(priorities):
+            self.styles[i] = (styles.pop() if styles else 'dotted',
+                              lengths.pop() if lengths else 0)
+        self.devices = set()
+        self.clusters = set()
+        self.externals = 0
+        print("digraph topology {")
+        print("rankdir=LR")
+        print("ranksep=2")
+
+    def node(self, name, group, props, device):
+        host = props['hostname']
+        print("subgraph cluster_{} {{".format(group))
+        if group not in self.clusters:
+            self.clusters.add(group)
+            print("style=dotted")
+            print('label="{}"'.format(group))
+        print("subgraph cluster_{} {{".format(host))
+        if (group, host) not in self.clusters:
+            self.clusters.add((group, host))
+            print('label="{}"'.format(host))
+            print('style=solid')
+            print('color=gray')
+        if device:
+            self.devices.add(name)
+            print('{0} [shape=record style=rounded '
+                  'label="{{<REP>REP | {1[role]} | <REQ>REQ}}"]'
+                  .format(name, props))
+        else:
+            print('{0} [label={1[role]}]'.format(name, props))
+        print("}")
+        print("}")
+
+    def edge(self, req, rep, addr, priority, reverse):
+        if reverse:
+            arrowhead, arrowtail = 'normal', 'none'
+        else:
+            arrowhead, arrowtail = 'none', 'inv'
+        if req in self.devices:
+            req = req + ':REQ'
+        if rep in self.devices:
+            rep = rep + ':REP'
+        style, length = self.styles[priority]
+        print('{} -> {} [style={} minlen={} arrowhead={} arrowtail={} '
+              'dir=both]'.format(req, rep, style, length,
+                                 arrowhead, arrowtail))
+
+    def external(self, name, addr, priority):
+        self.externals += 1
+        print('ext_{} [shape=octagon label="{}"]'
+            .format(self.externals, addr[len('tcp://'):]))
+        if priority is None:
+            print('ext_{} -> {} [style="{}"]'
+                .format(self.externals, name, self.styles[priority][0]))
+        else:
+            print('{} -> ext_{} [style="{}" dir=back arrowhead=inv]'
+                .format(name, self.externals, self.styles[priority][0]))
+
+    def finish(self):
+        print('{rank=same;',
+            ' '.join('ext_' + str(i) for i in range(1, self.externals + 1)),
+            '}')
+        print("}")
+
+
+class JsonWriter(object):
+    """Writes instance graph as JSON lines of nodes and edges"""
+
+    def node(self, name, group, props, device):
+        print(json.dumps({'type': 'node', 'name': name, 'group': group,
+                          'host': props['hostname'], 'role': props['role'],
+                          'device': device}))
+
+    def edge(self, req, rep, addr, priority, reverse):
+        print(json.dumps({'type': 'edge', 'from': req, 'to': rep,
+                          'address': addr, 'priority': priority}))
+
+    def external(self, name, addr, priority):
+        print(json.dumps({'type': 'external', 'node': name,
+                          'address': addr, 'priority': priority}))
+
+    def finish(self):
+        pass
+
+
+def request_priorities(db):
+    """Returns priorities of all connections of reqrep topologies"""
+    result = set()
+    for top in db.topologies.values():
+        if top.type != 'reqrep':
+            continue
+        for nodes in top.rules.values():
+            for node in nodes:
+                for conns in node.connections.values():
+                    for conn in conns:
+                        result.add(conn.info.priority)
+    return result
+
+
+def draw_instance_graph(options, db):
+    if options.raw or options.json:
         stream = sys.stdout
     else:
         fn = 'instance_graph.png'
@@ -79,71 +257,107 @@ def draw_instance_graph(options, db):
             stdin=subprocess.PIPE)
         stream = io.TextIOWrapper(proc.stdin)
     with set_stdout(stream):
-        print("digraph topology {")
-        print("rankdir=LR")
-        print("ranksep=2")
+        if options.json:
+            graph = InstanceGraph(JsonWriter())
+        else:
+            graph = InstanceGraph(DotWriter(request_priorities(db)))
+        for result in map_lines(options, db, graph_line):
+            graph.add_node(*result)
+        graph.finish()
 
-        for group, ghosts in hosts.items():
-            print("subgraph cluster_{} {{".format(group))
-            print("style=dotted")
-            print('label="{}"'.format(group))
-            for host, ndict in ghosts.items():
-                print("subgraph cluster_{} {{".format(host))
-                print('label="{}"'.format(host))
-                print('style=solid')
-                print('color=gray')
-                for name, props in ndict.items():
-                    if name in devices:
-                        print('{0} [shape=record style=rounded '
-                              'label="{{<REP>REP | {1[role]} | <REQ>REQ}}"]'
-                            .format(name, props))
-                    else:
-                        print('{0} [label={1[role]}]'.format(name, props))
-                print("}")
-            print("}")
-
-        for addr, nlist in bind.items():
-            nlist = set(nlist)
-            targlist = conn.pop(addr, None)
-            if targlist is not None:
-                for (pa, a), (pb, b) in product(nlist, targlist):
-                    if pa: # priority is in a req socket
-                        prio = pa
-                        arrowhead = 'none'
-                        arrowtail = 'inv'
-                    else:
-                        prio = pb
-                        a, b = b, a
-                        arrowhead = 'normal'
-                        arrowtail = 'none'
-                    if a in devices:
-                        a = a + ':REQ'
-                    if b in devices:
-                        b = b + ':REP'
-
-                    print('{} -> {} [style={} minlen={} arrowhead={} arrowtail={} dir=both]'
-                        .format(a, b, priostyles[prio], priolengths[prio],
-                            arrowhead, arrowtail))
+
+def verify_line(item):
+    """Resolves a line of list file, returns list of result records
+
+    A record is made for each socket of the line, having either
+    ``addresses`` or ``error`` with ``kind`` and ``message``
+    """
+    fn, num, line = item
+    try:
+        url, nodetype = line.split()
+    except ValueError:
+        return [{'file': fn, 'line': num, 'url': line, 'socktype': None,
+                 'error': {'kind': 'malformed',
+                           'message': "Expected url and socket type"}}]
+    records = []
+    for socktype in socktypes_for(nodetype):
+        rec = {'file': fn, 'line': num, 'url': url, 'socktype': socktype}
+        try:
+            rec['addresses'] = list(_db.resolve(None, None, url, socktype))
+        except Exception as e:
+            rec['error'] = {'kind': error_kind(e), 'message': repr(e)}
+        records.append(rec)
+    return records
+
+
+def verify(options, db):
+    """Prints JSON line for every socket of list files in input order
+
+    Returns number of errors
+    """
+    lines = errors = 0
+    for records in map_lines(options, db, verify_line):
+        lines += 1
+        for rec in records:
+            if 'error' in rec:
+                errors += 1
+            print(json.dumps(rec))
+    print("Verified {} lines, {} errors".format(lines, errors),
+          file=sys.stderr)
+    return errors
+
+
+def diff_line(item):
+    """Compares answers of old and new database to a line of list file
+
+    Answers are resolved only if fingerprints differ. Returns list of
+    ``(url, socktype, added, removed)`` for changed sockets, where
+    ``added`` and ``removed`` are lists of lines, or error messages
+    prefixed by ``!`` if resolve fails.
+    """
+    old, new = _db
+    fn, num, line = item
+    url, nodetype = line.split()
+    result = []
+    for socktype in socktypes_for(nodetype):
+        answers = []
+        for db in (old, new):
+            try:
+                fp = db.fingerprint(None, None, url, socktype)
+                answers.append((fp, None))
+            except Exception as e:
+                answers.append((None, '! {}: {!r}'.format(error_kind(e), e)))
+        if answers[0][0] is not None and answers[0][0] == answers[1][0]:
+            continue
+        lines = []
+        for db, (fp, error) in zip((old, new), answers):
+            if error is None:
+                lines.append(list(db.resolve(None, None, url, socktype)))
             else:
-                for p, n in nlist:
-                    counter += 1
-                    if p is None: # priority is in a req socket
-                        print('ext_{} [shape=octagon label="{}"]'
-                            .format(counter, addr[len('tcp://'):]))
-                        print('ext_{} -> {} [style="{}"]'
-                            .format(counter, n, priostyles[p]))
-                    else:
-                        print('ext_{} [shape=octagon label="{}"]'
-                            .format(counter, addr[len('tcp://'):]))
-                        print('{} -> ext_{} [style="{}" dir=back arrowhead=inv]'
-                            .format(n, counter, priostyles[p]))
-        print('{rank=same;',
-            ' '.join('ext_' + str(i) for i in range(1, counter+1)),
-            '}')
-        if conn:
-            raise ValueError(conn)
+                lines.append([error])
+        added = [l for l in lines[1] if l not in lines[0]]
+        removed = [l for l in lines[0] if l not in lines[1]]
+        if added or removed:
+            result.append((url, socktype, added, removed))
+    return result
 
-        print("}")
+
+def diff(options, old, new):
+    """Prints sockets of list files whose addresses differ in databases
+
+    Returns number of changed sockets
+    """
+    changed = 0
+    for result in map_lines(options, (old, new), diff_line):
+        for url, socktype, added, removed in result:
+            changed += 1
+            print(url, socktype)
+            for line in removed:
+                print('   -', line)
+            for line in added:
+                print('   +', line)
+    print("{} sockets changed".format(changed), file=sys.stderr)
+    return changed
 
 
 def draw_layout_graph(options, lname, layout):
@@ -179,7 +393,7 @@ def draw_layout_graph(options, lname, layout):
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument('topology_files', nargs='+',
+    ap.add_argument('topology_files', nargs='*',
         help="Files to read topology from")
     ap.add_argument('-l', '--list-file', default=[], action="append",
         help="The text file with list of name requests to run tests against")
@@ -187,16 +401,37 @@ def main():
         help="Draw bare diagram for a single layout from topology file")
     ap.add_argument('-G', '--instance-graph', action="store_true",
         help="Draw diagram of nodes read from --list-file")
+    ap.add_argument('--json', action="store_true",
+        help="Print instance graph as JSON lines of nodes and edges")
     ap.add_argument('-p', '--print-addresses', action="store_true",
         help="Print addresses resolved for each --list-file")
     ap.add_argument('--raw', action="store_true",
         help="Print graph data instead of drawing graph")
+    ap.add_argument('-V', '--verify', action="store_true",
+        help="Resolve every line of --list-file, print results and errors "
+             "as JSON lines, exit with non-zero status on errors")
+    ap.add_argument('-D', '--diff', nargs=2, metavar=('OLD', 'NEW'),
+        help="Print sockets of --list-file which get different addresses "
+             "from NEW topology file than from OLD one")
+    ap.add_argument('-W', '--who', metavar='ADDRESS', default=[],
+        action='append',
+        help="Print nodes binding and connecting to the address")
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help="Number of processes resolving --list-file for --verify and "
+             "--instance-graph (default is number of cpus)")
     options = ap.parse_args()
 
+    if options.diff:
+        old, new = Database(), Database()
+        old.add_from_file(options.diff[0])
+        new.add_from_file(options.diff[1])
+        diff(options, old, new)
+        return
+    if not options.topology_files:
+        ap.error("Topology files are required unless --diff is used")
 
     db = Database()
-    for i in options.topology_files:
-        db.add_from_file(i)
+    db.add_from_files(options.topology_files)
 
     if options.print_addresses:
         for fn in options.list_file:
@@ -215,18 +450,29 @@ def main():
                         for addr in db.resolve(None, None, url, socktype):
                             print('   ', addr)
 
+    for addr in options.who:
+        print(addr)
+        for line in db.who_lines(addr):
+            print('   ', line)
+
+    errors = 0
+    if options.verify:
+        errors = verify(options, db)
+
     if options.instance_graph:
         draw_instance_graph(options, db)
 
     if options.layout_graph:
         for i in options.topology_files:
-            with open(i, 'rt') as f:
-                data = yaml.load(f)
+            data = load_file(i)
             ldata = data['layouts'].get(options.layout_graph)
             if ldata is not None:
                 draw_layout_graph(options, options.layout_graph, ldata)
                 break
 
+    if errors:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
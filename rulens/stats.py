@@ -0,0 +1,102 @@
+"""
+    Counters of the name service, served as JSON over nanomsg
+"""
+import json
+import time
+import threading
+from collections import defaultdict
+
+
+class Histogram(object):
+    """Latency histogram with power of two buckets in microseconds"""
+    BUCKETS = 24
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, nanoseconds):
+        self.count += 1
+        self.total += nanoseconds
+        idx = (nanoseconds // 1000).bit_length()
+        self.buckets[min(idx, self.BUCKETS - 1)] += 1
+
+    def snapshot(self):
+        """Returns counts keyed by upper bound of bucket in microseconds"""
+        return {
+            'count': self.count,
+            'sum_us': self.total / 1000,
+            'buckets': {('le_{}'.format(1 << i) if i < self.BUCKETS - 1
+                         else 'inf'): n
+                        for i, n in enumerate(self.buckets) if n},
+            }
+
+
+class Counters(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = defaultdict(int)
+        self.cache_hits = 0
+        self.parse = Histogram()
+        self.resolve = Histogram()
+        self.encode = Histogram()
+
+    def snapshot(self):
+        return {
+            'requests': self.requests,
+            'errors': dict(self.errors),
+            'cache_hits': self.cache_hits,
+            'parse': self.parse.snapshot(),
+            'resolve': self.resolve.snapshot(),
+            'encode': self.encode.snapshot(),
+            }
+
+
+class Stats(object):
+    """Per-topology and per-socktype counters
+
+    Updated from the request loop only, and read by the thread serving
+    snapshots. Snapshots may be slightly inconsistent, which is fine for
+    counters.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.by_topology = defaultdict(Counters)
+        self.by_socktype = defaultdict(Counters)
+
+    def record(self, topology, socktype, *, error=None, cache_hit=False,
+               parse=None, resolve=None, encode=None):
+        for cnt in (self.by_topology[topology], self.by_socktype[socktype]):
+            cnt.requests += 1
+            if error is not None:
+                cnt.errors[error] += 1
+            if cache_hit:
+                cnt.cache_hits += 1
+            if parse is not None:
+                cnt.parse.add(parse)
+            if resolve is not None:
+                cnt.resolve.add(resolve)
+            if encode is not None:
+                cnt.encode.add(encode)
+
+    def snapshot(self):
+        return {
+            'uptime': time.time() - self.started,
+            'topologies': {name: cnt.snapshot()
+                           for name, cnt in list(self.by_topology.items())},
+            'socktypes': {name: cnt.snapshot()
+                          for name, cnt in list(self.by_socktype.items())},
+            }
+
+    def serve(self, addr):
+        """Starts a thread replying with JSON snapshot to every request"""
+        from . import nanomsg
+
+        thread = threading.Thread(target=nanomsg.reply_service,
+            args=(addr, lambda req: json.dumps(self.snapshot()).encode()),
+            name='rulens-stats', daemon=True)
+        thread.start()
+        return thread
@@ -26,15 +26,98 @@ def match_rule(props, node):
         for k, v in rule.items():
             if v != props.get(k):
                 return False
-    if hasattr(node, 'children'):
-        for n in node.children:
-            for rule in n.rules:
-                for k, v in rule.items():
-                    if v != props.get(k):
-                        return False
+    for n in node.children:
+        for rule in n.rules:
+            for k, v in rule.items():
+                if v != props.get(k):
+                    return False
     return True
 
 
+def rule_requirements(node):
+    """Merges all rules ``match_rule`` checks for the node into single dict
+
+    Returns ``None`` if rules contradict each other, so node can't ever match
+    """
+    result = {}
+    rules = list(node.rules)
+    for n in node.children:
+        rules.extend(n.rules)
+    for rule in rules:
+        for k, v in rule.items():
+            if k in result and result[k] != v:
+                return None
+            result[k] = v
+    if result == node.properties:
+        return node.properties  # share dict with the node
+    return result
+
+
+class RuleIndex(object):
+    """Decision tree over rules of a single role
+
+    Each level splits nodes by value of the most common property. Nodes which
+    don't constrain the property are kept in the ``wildcard`` subtree.
+    Positions of nodes are kept to preserve first-match semantics of the
+    linear scan. Requirements are shared with nodes rather than copied, so
+    leaves check again the properties ``used`` for splitting above.
+    """
+    LEAF_SIZE = 4
+
+    def __init__(self, entries, used=frozenset()):
+        self.key = None
+        self.entries = entries
+        if len(entries) <= self.LEAF_SIZE:
+            return
+        counts = defaultdict(int)
+        for pos, req, node in entries:
+            for k in req:
+                if k not in used:
+                    counts[k] += 1
+        if not counts:
+            return
+        key = max(counts, key=counts.get)
+        buckets = defaultdict(list)
+        wildcard = []
+        for pos, req, node in entries:
+            if key in req:
+                try:
+                    hash(req[key])
+                except TypeError:
+                    wildcard.append((pos, req, node))
+                    continue
+                buckets[req[key]].append((pos, req, node))
+            else:
+                wildcard.append((pos, req, node))
+        if not buckets or len(wildcard) == len(entries):
+            return
+        self.key = key
+        self.entries = None
+        used = used | {key}
+        self.buckets = {val: RuleIndex(lst, used)
+                        for val, lst in buckets.items()}
+        self.wildcard = RuleIndex(wildcard, used) if wildcard else None
+
+    def lookup(self, props):
+        """Returns ``(position, node)`` of first matching node or ``None``"""
+        if self.key is None:
+            for pos, req, node in self.entries:
+                for k, v in req.items():
+                    if v != props.get(k):
+                        break
+                else:
+                    return pos, node
+            return None
+        best = None
+        sub = self.buckets.get(props.get(self.key))
+        if sub is not None:
+            best = sub.lookup(props)
+        if self.wildcard is not None:
+            other = self.wildcard.lookup(props)
+            if other is not None and (best is None or other[0] < best[0]):
+                best = other
+        return best
+
 
 class Topology(object):
 
@@ -43,21 +126,38 @@ class Topology(object):
         self.type = type
         self.party_mapping = PARTIES[type]
         self.rules = defaultdict(list)
+        self._index = {}
 
     def __repr__(self):
         return '<{} {} {!r}>'.format(
             self.__class__.__name__, self.type, self.name)
 
     def resolve_node(self, role, props):
-        for node in self.rules[role]:
-            if match_rule(props, node):
-                break
-        else:
+        index = self._index.get(role)
+        if index is None:
+            index = self._build_role_index(role)
+        found = index.lookup(props)
+        if found is None:
             raise AssertionError("No rule for node")
-        return node
+        return found[1]
 
     def add_rule(self, role, rule):
         self.rules[role].append(rule)
+        self._index.pop(role, None)
+
+    def _build_role_index(self, role):
+        entries = []
+        for pos, node in enumerate(self.rules.get(role, ())):
+            req = rule_requirements(node)
+            if req is not None:
+                entries.append((pos, req, node))
+        index = self._index[role] = RuleIndex(entries)
+        return index
+
+    def build_index(self):
+        """Compiles rules of every role, called when topology is built"""
+        for role in list(self.rules):
+            self._build_role_index(role)
 
 
 class ExternTopology(Topology):
@@ -0,0 +1,53 @@
+"""
+    Parsing of ``topology://name?key=value&...`` urls
+
+    Gives same results as ``urlparse(url).netloc`` and
+    ``dict(parse_qsl(urlparse(url).query))``. Urls that need anything
+    beyond splitting (quoting, whitespace, fragments, ipv6-like brackets,
+    non-ascii) go through ``urllib`` itself.
+"""
+import sys
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qsl
+
+
+PREFIX = 'topology://'
+# Characters urllib may unquote, strip or treat specially
+_SLOW = frozenset('%+#[]\x7f' + ''.join(map(chr, range(33))))
+
+
+def _slow(url):
+    parsed = urlparse(url)
+    return parsed.netloc, tuple(parse_qsl(parsed.query))
+
+
+@lru_cache(maxsize=4096)
+def _parse(url):
+    if (not url.startswith(PREFIX) or not url.isascii()
+            or not _SLOW.isdisjoint(url)):
+        name, pairs = _slow(url)
+    else:
+        rest = url[len(PREFIX):]
+        end = len(rest)
+        for delim in '/?':
+            idx = rest.find(delim, 0, end)
+            if idx >= 0:
+                end = idx
+        name = rest[:end]
+        query = rest[end:].partition('?')[2]
+        pairs = []
+        for field in query.split('&'):
+            key, eq, value = field.partition('=')
+            if value:
+                pairs.append((key, value))
+    return sys.intern(name), tuple((sys.intern(k), sys.intern(v))
+                                   for k, v in pairs)
+
+
+def parse_url(url):
+    """Returns topology name and new dict of query parameters
+
+    Parsed urls are cached, so repeated urls cost a dict copy only
+    """
+    name, pairs = _parse(url)
+    return name, dict(pairs)
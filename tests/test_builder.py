@@ -0,0 +1,246 @@
+"""
+    Answers for the example topologies are the same as before the builder
+    was reworked
+
+    The expected answers in ``data/examples.json`` were recorded from the
+    original builder. Sockets having ``default: random`` connections are
+    recorded with every address they were seen to get and the number of
+    addresses they get each time.
+"""
+import io
+import os
+import json
+from collections import defaultdict
+
+import pytest
+
+from rulens import snapshot
+from rulens.db import Database
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = ('onedc', 'twodc', 'threedc')
+
+
+def expected_answers():
+    with open(os.path.join(ROOT, 'tests', 'data', 'examples.json')) as f:
+        records = json.load(f)
+    result = defaultdict(list)
+    for rec in records:
+        result[rec['example']].append(rec)
+    return result
+
+
+def load(example, mode):
+    db = Database(lazy=mode == 'lazy')
+    db.add_from_file(os.path.join(ROOT, 'examples', example, 'topology.yaml'))
+    if mode == 'snapshot':
+        buf = io.BytesIO()
+        db.dump_snapshot(buf)
+        db = Database()
+        db.topologies.update(snapshot.loads(buf.getvalue()))
+    return db
+
+
+@pytest.mark.parametrize('mode', ['eager', 'lazy', 'snapshot'])
+@pytest.mark.parametrize('example', EXAMPLES)
+def test_example_answers(example, mode):
+    records = expected_answers()[example]
+    assert records
+    db = load(example, mode)
+    for rec in records:
+        got = sorted(db.resolve(None, None, rec['url'], rec['socktype']))
+        if 'addresses' in rec:
+            assert got == rec['addresses'], rec
+        else:
+            assert len(got) == rec['random']['count'], rec
+            assert set(got) <= set(rec['random']['choices']), rec
+
+
+def test_examples_cover_all_sockets():
+    # every socket of addresses.txt has an expected answer
+    records = expected_answers()
+    for example in EXAMPLES:
+        recorded = {(rec['url'], rec['socktype']) for rec in records[example]}
+        listed = set()
+        path = os.path.join(ROOT, 'examples', example, 'addresses.txt')
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                url, nodetype = line.split()
+                if nodetype == 'device':
+                    listed.update({(url, 'NN_REQ'), (url, 'NN_REP')})
+                else:
+                    listed.add((url, nodetype))
+        assert recorded == listed
+
+
+def test_pinned_routes():
+    # rules of cluster1 pin workers to balancers, the ones not listed
+    # (and not behind a device) get a random balancer
+    db = load('onedc', 'eager')
+    pinned = {'127.1.22.2': '127.1.11.2', '127.1.22.3': '127.1.11.1',
+              '127.1.22.4': '127.1.11.1', '127.1.22.5': '127.1.11.2',
+              '127.1.22.6': '127.1.11.2'}
+    for worker, balancer in pinned.items():
+        url = 'topology://internal?role=worker&dc=first&ip=' + worker
+        for _ in range(20):
+            assert list(db.resolve(None, None, url, 'NN_REP')) == [
+                'connect:8:tcp://{}:10001'.format(balancer)]
+
+
+SMALL = """
+layouts:
+  cluster:
+    balancer -> worker:
+      port: 10001
+  world: {{}}
+groups:
+  cluster1:
+    layout: cluster
+    rule:
+      dc: first
+    children:
+      balancer:
+{balancers}
+    connections:
+      balancer -> worker:
+{connection}
+topologies:
+  internal:
+    type: reqrep
+    layout: world
+    children:
+    - cluster1
+"""
+POOLS = ['a', 'a', 'b']
+
+
+def small(tmp_path, connection, balancers=None, lazy=False):
+    """Builds topology of three balancers and workers connecting to them"""
+    if balancers is None:
+        balancers = [{'pool': pool} for pool in POOLS]
+    lines = []
+    for i, props in enumerate(balancers, 1):
+        props = dict(props, ip='127.0.0.{}'.format(i))
+        lines.append('      - {' + ', '.join('{}: {}'.format(k, v)
+                                             for k, v in props.items()) + '}')
+    path = tmp_path / 'topology.yaml'
+    path.write_text(SMALL.format(
+        balancers='\n'.join(lines),
+        connection='\n'.join('        ' + line
+                             for line in connection.strip().splitlines())))
+    db = Database(lazy=lazy)
+    db.add_from_file(str(path))
+    return db
+
+
+def balancers(db, **props):
+    url = 'topology://internal?role=worker&dc=first&' + '&'.join(
+        '{}={}'.format(k, v) for k, v in props.items())
+    return [line.split(':')[3][len('//'):]
+            for line in db.resolve(None, None, url, 'NN_REP')]
+
+
+def test_rule_matches_every_node(tmp_path):
+    db = small(tmp_path, """
+match_by: pool
+rules:
+- a -> x
+- b -> y
+""")
+    assert balancers(db, pool='x') == ['127.0.0.1', '127.0.0.2']
+    assert balancers(db, pool='y') == ['127.0.0.3']
+    # not in the rules, the default is all
+    assert balancers(db, pool='z') == ['127.0.0.1', '127.0.0.2',
+                                       '127.0.0.3']
+
+
+@pytest.mark.parametrize('rule', ['c -> x', 'a x'])
+def test_wrong_rule(tmp_path, rule):
+    with pytest.raises(ValueError):
+        small(tmp_path, """
+match_by: pool
+rules:
+- a -> x
+- {}
+""".format(rule))
+
+
+def snapshot_of(db):
+    buf = io.BytesIO()
+    db.dump_snapshot(buf)
+    result = Database()
+    result.topologies.update(snapshot.loads(buf.getvalue()))
+    return result
+
+
+def spread(db, count=600):
+    """Returns balancer picked for each of ``count`` workers"""
+    return [balancers(db, pool='z', ip='10.0.{}.{}'.format(i // 250, i % 250))
+            for i in range(count)]
+
+
+@pytest.mark.parametrize('default', ['hash', 'rendezvous'])
+def test_hashing_is_stable(tmp_path, default):
+    connection = """
+match_by: pool
+hash_by: ip
+rules:
+- a -> x
+default: {}
+""".format(default)
+    db = small(tmp_path, connection)
+    picks = spread(db)
+    assert all(len(pick) == 1 for pick in picks)
+    assert {pick[0] for pick in picks} == {'127.0.0.1', '127.0.0.2',
+                                           '127.0.0.3'}
+    # the same for the same worker, whichever way topology is made
+    assert spread(db) == picks
+    assert spread(small(tmp_path, connection)) == picks
+    assert spread(small(tmp_path, connection, lazy=True)) == picks
+    assert spread(snapshot_of(db)) == picks
+    # rules are still followed
+    assert balancers(db, pool='x', ip='10.0.0.1') == ['127.0.0.1',
+                                                      '127.0.0.2']
+
+
+@pytest.mark.parametrize('default', ['hash', 'rendezvous'])
+def test_weight_changes_spread(tmp_path, default):
+    connection = """
+match_by: pool
+hash_by: ip
+default: {}
+""".format(default)
+    weighted = [{'pool': pool, 'weight': weight}
+                for pool, weight in zip(POOLS, [1, 1, 4])]
+    even = spread(small(tmp_path, connection))
+    heavy = spread(small(tmp_path, connection, weighted))
+    for picks in (even, heavy):
+        assert {pick[0] for pick in picks} == {'127.0.0.1', '127.0.0.2',
+                                               '127.0.0.3'}
+    assert 100 < even.count(['127.0.0.3']) < 300
+    assert heavy.count(['127.0.0.3']) > 300
+    # workers only move to the node made heavier
+    assert all(a == b for a, b in zip(even, heavy) if b != ['127.0.0.3'])
+
+
+def test_wrong_default(tmp_path):
+    with pytest.raises(ValueError):
+        small(tmp_path, """
+match_by: pool
+default: roundrobin
+""")
+
+
+@pytest.mark.parametrize('default', ['hash', 'rendezvous'])
+@pytest.mark.parametrize('weight', [0, -1])
+def test_wrong_weight(tmp_path, default, weight):
+    with pytest.raises(ValueError):
+        small(tmp_path, """
+match_by: pool
+hash_by: ip
+default: {}
+""".format(default), [{'pool': 'a', 'weight': weight}, {'pool': 'b'}])
@@ -0,0 +1,85 @@
+"""
+    Soak test of the request loop: server memory stays flat
+
+    Needs the nanomsg library, skipped if it isn't found. The number of
+    requests is taken from ``RULENS_SOAK_REQUESTS`` environment variable,
+    set it to a few millions for a long run.
+"""
+import os
+import sys
+import subprocess
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REQUESTS = int(os.environ.get('RULENS_SOAK_REQUESTS', 200000))
+# Allowed growth after warm up, a leak of the message chunk per request
+# is megabytes by the end
+SLACK_KB = 1024
+
+
+@pytest.fixture(scope='module')
+def nanomsg():
+    try:
+        from rulens import nanomsg
+    except (OSError, AttributeError):
+        # AttributeError is raised if nanomsg library isn't found
+        pytest.skip("nanomsg library is not available")
+    return nanomsg
+
+
+def rss_kb(pid):
+    with open('/proc/{}/status'.format(pid), 'rt') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def requests():
+    example = os.path.join(ROOT, 'examples', 'onedc')
+    result = [b'REQUEST - - topology://internal?role=nope NN_REQ']
+    with open(os.path.join(example, 'addresses.txt')) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            url, nodetype = line.split()
+            for socktype in ('NN_REQ', 'NN_REP'):
+                result.append('REQUEST - - {} {}'.format(url, socktype)
+                              .encode('ascii'))
+    return result
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason="reads RSS from /proc")
+def test_server_rss_is_flat(nanomsg, tmp_path):
+    addr = 'ipc://' + str(tmp_path / 'soak.ipc')
+    topology = os.path.join(ROOT, 'examples', 'onedc', 'topology.yaml')
+    proc = subprocess.Popen([sys.executable, '-m', 'rulens', topology,
+                             '--bind', addr], cwd=ROOT)
+    sock = nanomsg.lib.nn_socket(nanomsg.const.AF_SP, nanomsg.const.REQ)
+    try:
+        nanomsg.setsockopt_int(sock, nanomsg.const.SOL_SOCKET,
+                               nanomsg.const.RCVTIMEO, 10000)
+        nanomsg.lib.nn_connect(sock, addr.encode('ascii'))
+        reqs = requests()
+
+        def roundtrip(req):
+            nanomsg.send_msg(sock, req)
+            with nanomsg.recv_msg(sock) as msg:
+                return bytes(msg.buffer)
+
+        # warm up, also waits for server to start
+        assert roundtrip(reqs[0]) == b'ERROR no_rule'
+        for i in range(10000):
+            roundtrip(reqs[i % len(reqs)])
+        start = rss_kb(proc.pid)
+        for i in range(REQUESTS):
+            roundtrip(reqs[i % len(reqs)])
+        end = rss_kb(proc.pid)
+    finally:
+        nanomsg.lib.nn_close(sock)
+        proc.terminate()
+        proc.wait()
+    assert end - start < SLACK_KB, (start, end)
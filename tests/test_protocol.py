@@ -0,0 +1,93 @@
+"""
+    Replies of the name service to single, BATCH and WHO requests
+"""
+import os
+
+import pytest
+
+from rulens.db import Database
+from rulens.stats import Stats
+from rulens.__main__ import serve_request
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BALANCER = ('topology://internal?ip=127.1.11.1&dc=first&role=balancer'
+            '&hostname=laura&pid=1110')
+GATEWAY = ('topology://internal?ip=127.1.6.1&dc=first&role=gateway_input'
+           '&hostname=gina&pid=610')
+
+
+@pytest.fixture
+def db():
+    db = Database()
+    db.add_from_file(os.path.join(ROOT, 'examples', 'onedc', 'topology.yaml'))
+    return db
+
+
+def request(url, socktype):
+    return 'REQUEST - - {} {}'.format(url, socktype)
+
+
+def serve(db, text, stats=None):
+    return serve_request(memoryview(text.encode('ascii')), db=db, stats=stats)
+
+
+def test_addresses(db):
+    assert serve(db, request(BALANCER, 'NN_REP')) == (
+        b'bind:8:tcp://127.1.11.1:10006\nconnect:8:tcp://127.1.6.1:10007')
+
+
+def test_empty_answer(db):
+    assert serve(db, request(GATEWAY, 'NN_REP')) == b''
+
+
+def test_errors(db):
+    assert (serve(db, request('topology://internal?role=nope', 'NN_REQ'))
+            == b'ERROR no_rule')
+    assert serve(db, request('topology://nope?role=x', 'NN_REQ')) == (
+        b'ERROR KeyError')
+    assert serve(db, 'REQUEST - -') == b'ERROR ValueError'
+
+
+def test_batch(db):
+    reply = serve(db, '\n'.join([
+        'BATCH',
+        request(BALANCER, 'NN_REP'),
+        request('topology://internal?role=nope', 'NN_REQ'),
+        request(GATEWAY, 'NN_REP'),
+        'REQUEST - - malformed',
+        request(BALANCER, 'NN_REP'),
+        ]))
+    assert reply.split(b'\n') == [
+        b'RESULT 2',
+        b'bind:8:tcp://127.1.11.1:10006',
+        b'connect:8:tcp://127.1.6.1:10007',
+        b'ERROR no_rule',
+        b'RESULT 0',
+        b'ERROR ValueError',
+        b'RESULT 2',
+        b'bind:8:tcp://127.1.11.1:10006',
+        b'connect:8:tcp://127.1.6.1:10007',
+        ]
+
+
+def test_who(db):
+    assert serve(db, 'WHO tcp://127.1.11.1:10006').split(b'\n') == [
+        b'bind:8:topology://internal?role=balancer&dc=first&ip=127.1.11.1',
+        b'connect:8:topology://internal?role=frontend&dc=first&ip=127.1.5.1',
+        b'connect:8:topology://internal?role=frontend&dc=first&ip=127.1.5.2',
+        ]
+    assert serve(db, 'WHO tcp://127.0.0.1:1') == b''
+
+
+def test_stats(db):
+    stats = Stats()
+    for _ in range(3):
+        serve(db, request(BALANCER, 'NN_REP'), stats)
+    serve(db, '\n'.join(['BATCH', request(BALANCER, 'NN_REP'),
+                         request('topology://internal?role=nope', 'NN_REQ')]),
+          stats)
+    counters = stats.snapshot()['topologies']['internal']
+    assert counters['requests'] == 5
+    assert counters['cache_hits'] == 3
+    assert counters['errors'] == {'no_rule': 1}
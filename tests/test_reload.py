@@ -0,0 +1,87 @@
+"""
+    Reloading keeps lazy mode lazy, and lazy databases survive fork
+"""
+import os
+import signal
+import threading
+
+import pytest
+
+from rulens.db import Database
+from rulens.reload import Reloader
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE = os.path.join(ROOT, 'examples', 'onedc', 'topology.yaml')
+URL = ('topology://internal?ip=127.1.11.1&dc=first&role=balancer'
+       '&hostname=laura&pid=1110')
+ADDRESS = 'tcp://127.1.11.1:10006'
+
+
+def renamed_copy(path):
+    # the same topologies under other names, so both files can be loaded
+    with open(EXAMPLE) as f:
+        text = f.read()
+    text = (text.replace('\n  internal:', '\n  internal2:')
+                .replace('\n  public:', '\n  public2:')
+                .replace('topology: internal\n', 'topology: internal2\n'))
+    with open(path, 'w') as f:
+        f.write(text)
+    return str(path)
+
+
+def test_lazy_who_looks_at_built_topologies():
+    eager = Database()
+    eager.add_from_file(EXAMPLE)
+    db = Database(lazy=True)
+    db.add_from_file(EXAMPLE)
+    assert db.who(ADDRESS) == []
+    assert not db.topologies
+    list(db.resolve(None, None, URL, 'NN_REP'))
+    assert db.who_lines(ADDRESS) == eager.who_lines(ADDRESS) != []
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_lazy_reloader_forks():
+    reloader = Reloader([EXAMPLE], lazy=True)
+    # workers are forked right after, no thread may hold a lock then
+    assert threading.active_count() == 1
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            signal.alarm(10)
+            db = reloader.db
+            lines = list(db.resolve(None, None, URL, 'NN_REP'))
+            if lines and db.who(ADDRESS):
+                code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_lazy_reload_builds_only_requested(tmp_path):
+    other = renamed_copy(tmp_path / 'other.yaml')
+    reloader = Reloader([EXAMPLE, other], lazy=True, preload=['public2'])
+    old = reloader.db
+    list(old.resolve(None, None, URL, 'NN_REP'))
+    assert set(old.topologies) == {'internal', 'public', 'internal2',
+                                   'public2'}
+
+    # touch the other file only
+    with open(other, 'a') as f:
+        f.write('\n')
+    reloader._run()
+    db = reloader.db
+    assert db is not old
+    assert db.topologies['internal'] is old.topologies['internal']
+    assert db._addresses['internal'] is old._addresses['internal']
+    assert set(db.who_lines(ADDRESS)) == set(old.who_lines(ADDRESS))
+
+    # topologies never requested stay unbuilt
+    db = Database(lazy=True)
+    db.add_from_files([EXAMPLE, other], processes=1)
+    db.preload(['public2'])
+    reloaded = db.reloaded(['public2'])
+    assert set(reloaded.topologies) == {'internal2', 'public2'}
@@ -0,0 +1,79 @@
+"""
+    The ``topology://`` parser gives the same results as urllib
+"""
+import sys
+import random
+from urllib.parse import urlparse, parse_qsl
+
+import pytest
+
+from rulens.url import parse_url
+
+
+# Delimiters, characters urllib quotes, strips or rejects, and non-ascii
+ALPHABET = 'ab=&?/;:.%+# []\t\n\x00\x7fé_-12AZ'
+PREFIXES = ['topology://', 'topology://', 'topology://', 'TOPOLOGY://',
+            'topology:', 'topology:/', 'http://', ' topology://', '']
+
+
+def by_urllib(url):
+    try:
+        parsed = urlparse(url)
+        return parsed.netloc, list(parse_qsl(parsed.query))
+    except ValueError:
+        return 'error'
+
+
+def by_parser(url):
+    try:
+        name, params = parse_url(url)
+        return name, list(params.items())
+    except ValueError:
+        return 'error'
+
+
+def random_urls(seed, count):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        body = ''.join(rnd.choice(ALPHABET)
+                       for _ in range(rnd.randrange(0, 25)))
+        yield rnd.choice(PREFIXES) + body
+
+
+def realistic_urls(seed, count):
+    rnd = random.Random(seed)
+    values = ['first', 'second', '127.1.5.1', 'worker', '', 'a=b', 'x%20y']
+    for _ in range(count):
+        query = '&'.join('{}={}'.format(rnd.choice('kpqr'), rnd.choice(values))
+                         for _ in range(rnd.randrange(0, 6)))
+        yield 'topology://{}?{}'.format(rnd.choice(['internal', 'public']),
+                                        query)
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_random_urls(seed):
+    for url in random_urls(seed, 25000):
+        # dicts keep the last of repeated keys, as dict(parse_qsl()) does
+        expected = by_urllib(url)
+        if expected != 'error':
+            expected = expected[0], list(dict(expected[1]).items())
+        assert by_parser(url) == expected, url
+
+
+@pytest.mark.parametrize('seed', range(2))
+def test_realistic_urls(seed):
+    for url in realistic_urls(seed, 10000):
+        expected = by_urllib(url)
+        expected = expected[0], list(dict(expected[1]).items())
+        assert by_parser(url) == expected, url
+
+
+def test_fresh_dict_with_interned_strings():
+    url = 'topology://internal?role=worker&ip=127.1.5.1'
+    name, params = parse_url(url)
+    params['role'] = 'changed'
+    assert parse_url(url) == ('internal',
+                              {'role': 'worker', 'ip': '127.1.5.1'})
+    for key, value in parse_url(url)[1].items():
+        assert sys.intern(key) is key
+        assert sys.intern(value) is value